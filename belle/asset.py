@@ -1,13 +1,53 @@
 # -*- coding: utf-8 -*-
 import sqlalchemy as sa
+import hashlib
+import os
 import tempfile
+import threading
 import logging
 import cStringIO
-import urllib2
+import httplib
+import Queue
+import socket
+import time
+import urlparse
 import re
 
+from belle import stats
+from belle.cache import DiskCache
+
 log = logging.getLogger(__name__)
 
+_engines = dict()
+_tables = dict()
+_packs = dict()
+_engines_lock = threading.Lock()
+
+def _engine(url):
+    with _engines_lock:
+        if url not in _engines:
+            _engines[url] = sa.create_engine(url)
+        return _engines[url]
+
+def _pack(path):
+    from belle.pack import Pack
+
+    mtime = os.stat(path + '.idx').st_mtime
+    with _engines_lock:
+        if path not in _packs or _packs[path][0] != mtime:
+            _packs[path] = (mtime, Pack(path))
+        return _packs[path][1]
+
+def _reflect(conn, name='asset'):
+    key = (conn.engine, name)
+    with _engines_lock:
+        if key not in _tables:
+            metadata = sa.MetaData()
+            with stats.timer('asset.reflect'):
+                metadata.reflect(bind=conn, only=[name])
+            _tables[key] = metadata.tables[name]
+        return _tables[key]
+
 class AssetNotFoundError(Exception):
     def __init__(self, key):
         self.key = key
@@ -20,10 +60,78 @@ class AssetNotFoundError(Exception):
 
 
 class Asset(object):
-    def __init__(self, filename=None, type=None, referral=False):
+    def __init__(self, filename=None, type=None, referral=False, key=None, data=None):
         self.filename = filename
         self.type = type
         self.referral = referral
+        self.key = key
+        self.data = data
+
+    def open(self):
+        if self.data is not None:
+            # Wraps the buffer without copying it up front, but every read() returns a copy of that chunk.
+            return cStringIO.StringIO(self.data)
+        return self.filename
+
+class AssetCache(object):
+    CHUNK = 1024 * 1024
+
+    class Store(DiskCache):
+        GRACE = 300
+        SIDECARS = ('.type',)
+
+    def __init__(self):
+        self.disk = None
+
+    def persist(self, path, limit=None):
+        if path is not None:
+            self.disk = self.Store(path, limit)
+        else:
+            self.disk = None
+
+    def lookup(self, key):
+        if self.disk is None:
+            return None
+        path = self.disk.lookup(key)
+        if path is None:
+            return None
+        type = self.disk.get(key + '.type')
+        if type is None:
+            return None
+        log.debug((u'using cached %s (%s) as %s' % (key, type, path)).encode('UTF-8'))
+        return Asset(filename=path, type=type.decode('UTF-8'), referral=True, key=key)
+
+    def store(self, key, asset):
+        if self.disk is None or asset.referral:
+            return asset
+        try:
+            with open(asset.filename, 'rb') as f:
+                path = self.disk.put_stream(key, iter(lambda: f.read(self.CHUNK), ''), hashlib.sha256())
+        except ValueError, e:
+            log.warn(unicode(e).encode('UTF-8'))
+            return asset
+        self.disk.put(key + '.type', (asset.type or u'').encode('UTF-8'))
+        os.remove(asset.filename)
+        return Asset(filename=path, type=asset.type, referral=True, key=key)
+
+    def store_stream(self, key, type, chunks):
+        if self.disk is None:
+            return None
+        try:
+            path = self.disk.put_stream(key, chunks(), hashlib.sha256())
+        except ValueError, e:
+            log.warn(unicode(e).encode('UTF-8'))
+            return None
+        log.debug((u'extracting %s (%s) as %s' % (key, type, path)).encode('UTF-8'))
+        self.disk.put(key + '.type', (type or u'').encode('UTF-8'))
+        return Asset(filename=path, type=type, referral=True, key=key)
+
+    def refresh(self, asset):
+        if self.disk is None or not asset.referral or asset.filename != self.disk._path(asset.key):
+            return True
+        return self.disk.lookup(asset.key) is not None
+
+cache = AssetCache()
 
 class AssetOperator(object):
     def match(self, key):
@@ -31,6 +139,9 @@ class AssetOperator(object):
 
 class AssetFactoryBase(object):
     KEY_EXTRACTOR = re.compile(ur'.*([0-9a-f]{64}).*')
+    PREFETCH_BATCH = 500
+    STREAM_THRESHOLD = 1024 * 1024
+    STREAM_CHUNK = 256 * 1024
 
     class FileCache(object):
         def __init__(self):
@@ -45,6 +156,9 @@ class AssetFactoryBase(object):
         def __setitem__(self, k, v):
             self.content[k] = v
 
+        def __delitem__(self, k):
+            del self.content[k]
+
         def cleanup(self):
             import os
             for asset in self.content.itervalues():
@@ -55,13 +169,53 @@ class AssetFactoryBase(object):
 
     def __init__(self, *args, **kwargs):
         self.files = self.FileCache()
+        self.lock = threading.RLock()
 
     def get(self, type, key):
         key = self._patch_key(key)
-        if key not in self.files:
-            tmp = self.extract(type, key)
-            self.files[key] = tmp
-        return self.files[key]
+        with self.lock:
+            self._refresh(key)
+            if key not in self.files:
+                tmp = cache.lookup(key)
+                if tmp is None:
+                    stats.count('asset.cache.miss')
+                    with stats.timer('asset.fetch'):
+                        tmp = cache.store(key, self.extract(type, key))
+                else:
+                    stats.count('asset.cache.hit')
+                tmp.key = key
+                self.files[key] = tmp
+            return self.files[key]
+
+    def prefetch(self, keys):
+        for key in self._missing(keys):
+            try:
+                self.get(None, key)
+            except AssetNotFoundError:
+                pass
+
+    def _missing(self, keys):
+        missing = []
+        with self.lock:
+            for key in keys:
+                key = self._patch_key(key)
+                self._refresh(key)
+                if key in self.files or key in missing:
+                    continue
+                cached = cache.lookup(key)
+                if cached is not None:
+                    stats.count('asset.cache.hit')
+                    self.files[key] = cached
+                else:
+                    stats.count('asset.cache.miss')
+                    missing.append(key)
+        return missing
+
+    def _refresh(self, key):
+        # Keep cached files we still hold fresh so eviction leaves them alone, and drop any that went anyway.
+        if key in self.files and not cache.refresh(self.files[key]):
+            log.debug((u'cached %s was evicted, fetching again' % key).encode('UTF-8'))
+            del self.files[key]
 
     def _patch_key(self, key):
         return self.KEY_EXTRACTOR.sub(u'\g<1>', key)
@@ -87,13 +241,16 @@ class AssetFactory(object):
             return RestAssetFactory(url[5:])
         if url.startswith('amber:'):
             return AmberAssetFactory(url[6:])
+        if url.startswith('pack:'):
+            return PackAssetFactory(url[5:])
         return SQLAAssetFactory(url)
 
 class SQLAAssetFactory(AssetFactoryBase):
     def __init__(self, url):
         super(SQLAAssetFactory, self).__init__(url)
-        self.engine = sa.create_engine(url)
+        self.engine = _engine(url)
         self.conn = None
+        self._operator = None
 
     def connect(self):
         self.conn = self.engine.connect()
@@ -106,25 +263,66 @@ class SQLAAssetFactory(AssetFactoryBase):
             self.conn = None
 
     def extract(self, type, key):
-        tmp = tempfile.NamedTemporaryFile(delete=False)
-        try:
-            tmp_type = None
+        if not self.conn:
+            self.connect()
+
+        row = self.operator.describe(key).first()
+        if row is None:
+            raise AssetNotFoundError(key)
+        type, length = row
+        return self._extract_stream(key, type, length)
+
+    def prefetch(self, keys):
+        with self.lock:
+            keys = self._missing(keys)
+            if not keys:
+                return
 
             if not self.conn:
                 self.connect()
 
-            for blob,type in self.operator.match(key):
-                log.debug((u'extracting %s (%s) as %s' % (key, type, tmp.name)).encode('UTF-8'))
-                tmp.write(blob)
-                return Asset(filename=tmp.name, type=type)
+            for i in xrange(0, len(keys), self.PREFETCH_BATCH):
+                small = []
+                for key,type,length in self.operator.describe_all(keys[i:i + self.PREFETCH_BATCH]).fetchall():
+                    if key in self.files:
+                        continue
+                    if length > self.STREAM_THRESHOLD:
+                        self.files[key] = self._extract_stream(key, type, length)
+                    else:
+                        small.append(key)
+                if small:
+                    for key,blob,type in self.operator.match_all(small):
+                        self.files[key] = self._extract_blob(key, type, blob)
+
+    def _extract_stream(self, key, type, length):
+        chunks = lambda: self.operator.stream(key, length or 0, self.STREAM_CHUNK)
+        asset = cache.store_stream(key, type, chunks)
+        if asset is not None:
+            return asset
+        tmp = tempfile.NamedTemporaryFile(delete=False)
+        try:
+            log.debug((u'extracting %s (%s) as %s' % (key, type, tmp.name)).encode('UTF-8'))
+            for chunk in chunks():
+                tmp.write(chunk)
+            return Asset(filename=tmp.name, type=type, key=key)
+        finally:
+            tmp.close()
 
-            raise AssetNotFoundError(key)
+    def _extract_blob(self, key, type, blob):
+        tmp = tempfile.NamedTemporaryFile(delete=False)
+        try:
+            log.debug((u'extracting %s (%s) as %s' % (key, type, tmp.name)).encode('UTF-8'))
+            tmp.write(blob)
+            stats.count('asset.bytes', len(blob))
         finally:
             tmp.close()
+        return cache.store(key, Asset(filename=tmp.name, type=type, key=key))
 
     @property
     def operator(self):
-        return self._Operator(self.conn)
+        if self._operator is None or self._operator.conn is not self.conn:
+            self._operator = self._Operator(self.conn)
+        return self._operator
 
     class _Operator(AssetOperator):
         def __init__(self, conn):
@@ -132,52 +330,194 @@ class SQLAAssetFactory(AssetFactoryBase):
             self.setup()
 
         def setup(self):
-            metadata = sa.MetaData()
-            metadata.reflect(bind=self.conn)
-            self.table = metadata.tables['asset']
+            self.table = _reflect(self.conn)
 
         def match(self, key):
             return self.conn.execute(sa.sql.select([self.table.c.blob, self.table.c.type], self.table.c.hash == key))
 
+        def match_all(self, keys):
+            return self.conn.execute(sa.sql.select([self.table.c.hash, self.table.c.blob, self.table.c.type], self.table.c.hash.in_(keys)))
+
+        def describe(self, key):
+            return self.conn.execute(sa.sql.select([self.table.c.type, sa.func.length(self.table.c.blob)], self.table.c.hash == key))
+
+        def describe_all(self, keys):
+            return self.conn.execute(sa.sql.select([self.table.c.hash, self.table.c.type, sa.func.length(self.table.c.blob)], self.table.c.hash.in_(keys)))
+
+        def stream(self, key, length, chunk):
+            if self.conn.dialect.name == 'sqlite':
+                # SQLite's substr() loads the whole blob on every call, so chunked selects are quadratic there; read it once.
+                for blob, in self.conn.execute(sa.sql.select([self.table.c.blob], self.table.c.hash == key)):
+                    for offset in xrange(0, len(blob), chunk):
+                        part = buffer(blob, offset, chunk)
+                        stats.count('asset.bytes', len(part))
+                        yield part
+                return
+            for offset in xrange(0, length, chunk):
+                for part, in self.conn.execute(sa.sql.select([sa.func.substr(self.table.c.blob, offset + 1, chunk)], self.table.c.hash == key)):
+                    stats.count('asset.bytes', len(part))
+                    yield part
+
+class HTTPConnectionPool(object):
+    def __init__(self, url, size=8, timeout=None):
+        parsed = urlparse.urlsplit(url)
+        self.scheme = parsed.scheme
+        self.netloc = parsed.netloc
+        self.path = parsed.path.rstrip('/')
+        self.timeout = timeout
+        self.idle = Queue.LifoQueue(size)
+
+    def request(self, path):
+        conn = self._acquire()
+        try:
+            conn.request('GET', '%s/%s' % (self.path, path), headers={'Connection': 'keep-alive'})
+            return conn, conn.getresponse()
+        except:
+            conn.close()
+            raise
+
+    def release(self, conn, resp):
+        if resp.will_close:
+            conn.close()
+            return
+        try:
+            self.idle.put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                break
+
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            if self.scheme == 'https':
+                return httplib.HTTPSConnection(self.netloc, timeout=self.timeout)
+            return httplib.HTTPConnection(self.netloc, timeout=self.timeout)
+
 class RestAssetFactory(AssetFactoryBase):
+    TIMEOUT = 30.0
+    RETRIES = 3
+    BACKOFF = 0.5
+    CONCURRENCY = 8
+    CHUNK = 64 * 1024
+
     def __init__(self, url):
         super(RestAssetFactory, self).__init__(url)
+        url, _, options = url.partition('#')
+        options = dict(urlparse.parse_qsl(options))
         self.prefix = url
+        self.timeout = float(options.get('timeout', self.TIMEOUT))
+        self.retries = int(options.get('retries', self.RETRIES))
+        self.backoff = float(options.get('backoff', self.BACKOFF))
+        self.concurrency = int(options.get('concurrency', self.CONCURRENCY))
+        self.pool = HTTPConnectionPool(url, size=self.concurrency, timeout=self.timeout)
+
+    def cleanup(self):
+        self.pool.close()
 
     def extract(self, type, key):
         tmp = tempfile.NamedTemporaryFile(delete=False)
         try:
-            url = u'%s/%s' % (self.prefix, key)
+            log.debug((u'requesting %s (%s) as %s [%s/%s]' % (key, type, tmp.name, self.prefix, key)).encode('UTF-8'))
+            content_type = self._fetch(key, tmp)
+            return Asset(filename=tmp.name, type=content_type, key=key)
+        except:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+        finally:
+            tmp.close()
 
-            log.debug((u'requesting %s (%s) as %s [%s]' % (key, type, tmp.name, url)).encode('UTF-8'))
+    def prefetch(self, keys):
+        from multiprocessing.pool import ThreadPool
 
-            req = urllib2.Request(url)
-            resp = urllib2.urlopen(req)
-            try:
-                tmp.write(resp.read())
-            except AttributeError:
-                raise resp
-            
-            return Asset(filename=tmp.name, type=resp.info()['Content-Type'])
+        keys = self._missing(keys)
+        if not keys:
+            return
+
+        pool = ThreadPool(min(self.concurrency, len(keys)))
+        try:
+            results = pool.map(self._prefetch_one, keys)
         finally:
-            tmp.close()
+            pool.terminate()
+
+        with self.lock:
+            for key, asset in zip(keys, results):
+                if asset is None:
+                    continue
+                if key in self.files:
+                    if not asset.referral:
+                        os.remove(asset.filename)
+                    continue
+                self.files[key] = cache.store(key, asset)
+
+    def _prefetch_one(self, key):
+        try:
+            return self.extract(None, key)
+        except AssetNotFoundError:
+            return None
+        except Exception, e:
+            log.warn((u'prefetching %s failed: %s' % (key, e)).encode('UTF-8'))
+            return None
+
+    def _fetch(self, key, out):
+        error = None
+        for attempt in xrange(self.retries + 1):
+            if attempt:
+                log.debug((u'requesting %s failed: %s, retrying' % (key, error)).encode('UTF-8'))
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+                out.seek(0)
+                out.truncate()
+            try:
+                conn, resp = self.pool.request(key)
+            except (socket.error, httplib.HTTPException), e:
+                error = e
+                continue
+            try:
+                if resp.status == 404:
+                    resp.read()
+                    raise AssetNotFoundError(key)
+                if resp.status >= 500:
+                    resp.read()
+                    error = httplib.HTTPException(u'%s/%s: %d %s' % (self.prefix, key, resp.status, resp.reason))
+                    continue
+                if resp.status != 200:
+                    raise httplib.HTTPException(u'%s/%s: %d %s' % (self.prefix, key, resp.status, resp.reason))
+                while True:
+                    chunk = resp.read(self.CHUNK)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+                    stats.count('asset.bytes', len(chunk))
+                return resp.getheader('Content-Type')
+            except (socket.error, httplib.IncompleteRead), e:
+                error = e
+                continue
+            finally:
+                if resp.isclosed():
+                    self.pool.release(conn, resp)
+                else:
+                    conn.close()
+        raise error
 
     @property
     def operator(self):
-        return self._Operator(self.prefix)
+        return self._Operator(self)
 
     class _Operator(AssetOperator):
-        def __init__(self, prefix):
-            self.prefix = prefix
+        def __init__(self, factory):
+            self.factory = factory
 
         def match(self, key):
-            url = u'%s/%s' % (self.prefix, key)
-            req = urllib2.Request(url)
-            resp = urllib2.urlopen(req)
-            try:
-                return resp.read(), resp.info()['Content-Type']
-            except AttributeError:
-                raise resp
+            buf = cStringIO.StringIO()
+            type = self.factory._fetch(key, buf)
+            return buf.getvalue(), type
 
 class AmberAssetFactory(AssetFactoryBase):
     def __init__(self, url):
@@ -187,8 +527,9 @@ class AmberAssetFactory(AssetFactoryBase):
         self.config = ConfigParser.SafeConfigParser()
         self.config.read(url)
 
-        self.engine = sa.create_engine(self.config.get('app:main', 'sqlalchemy.url'))
+        self.engine = _engine(self.config.get('app:main', 'sqlalchemy.url'))
         self.conn = None
+        self._operator = None
 
     def connect(self):
         self.conn = self.engine.connect()
@@ -205,17 +546,36 @@ class AmberAssetFactory(AssetFactoryBase):
             self.connect()
 
         for path,type in self.operator.match(key):
-            if path is None:
-                path = u'%s/%s.bin' % (self.config.get('app:main', 'amber.store'), key)
-                path = path.replace(u'//', u'/')
-            log.debug((u'Referring %s (%s) as %s' % (key, type, path)).encode('UTF-8'))
-            return Asset(filename=path.encode(self.config.get('app:main', 'amber.store.encoding')), type=type, referral=True)
+            return self._refer(key, path, type)
 
         raise AssetNotFoundError(key)
-    
+
+    def prefetch(self, keys):
+        with self.lock:
+            keys = self._missing(keys)
+            if not keys:
+                return
+
+            if not self.conn:
+                self.connect()
+
+            for i in xrange(0, len(keys), self.PREFETCH_BATCH):
+                for key,path,type in self.operator.match_all(keys[i:i + self.PREFETCH_BATCH]):
+                    if key not in self.files:
+                        self.files[key] = self._refer(key, path, type)
+
+    def _refer(self, key, path, type):
+        if path is None:
+            path = u'%s/%s.bin' % (self.config.get('app:main', 'amber.store'), key)
+            path = path.replace(u'//', u'/')
+        log.debug((u'Referring %s (%s) as %s' % (key, type, path)).encode('UTF-8'))
+        return Asset(filename=path.encode(self.config.get('app:main', 'amber.store.encoding')), type=type, referral=True, key=key)
+
     @property
     def operator(self):
-        return self._Operator(self.conn)
+        if self._operator is None or self._operator.conn is not self.conn:
+            self._operator = self._Operator(self.conn)
+        return self._operator
 
     class _Operator(AssetOperator):
         def __init__(self, conn):
@@ -223,13 +583,27 @@ class AmberAssetFactory(AssetFactoryBase):
             self.setup()
 
         def setup(self):
-            metadata = sa.MetaData()
-            metadata.reflect(bind=self.conn)
-            self.table = metadata.tables['asset']
+            self.table = _reflect(self.conn)
 
         def match(self, key):
             return self.conn.execute(sa.sql.select([self.table.c.path, self.table.c.type], self.table.c.hash == key))
 
+        def match_all(self, keys):
+            return self.conn.execute(sa.sql.select([self.table.c.hash, self.table.c.path, self.table.c.type], self.table.c.hash.in_(keys)))
+
+
+class PackAssetFactory(AssetFactoryBase):
+    def __init__(self, url):
+        super(PackAssetFactory, self).__init__(url)
+        self.path = url
+
+    def extract(self, type, key):
+        found = _pack(self.path).get(key)
+        if found is None:
+            raise AssetNotFoundError(key)
+        type, data = found
+        log.debug((u'mapping %s (%s) from %s' % (key, type, self.path)).encode('UTF-8'))
+        return Asset(type=type, referral=True, key=key, data=data)
 
 class ImageThumbnailer(object):
     def __init__(self, asset_blob, x, y):
@@ -289,6 +663,6 @@ class AssetThumbnailGenerator(object):
         with AssetFactory(self.url) as assets:
             asset = assets.get(None, key)
             if re.search(u'^(font|ttf|ttc|otf)$', asset.type):
-                return FontThumbnailer(asset.filename, self.x, self.y).generate()
+                return FontThumbnailer(asset, self.x, self.y).generate()
             else:
-                return ImageThumbnailer(asset.filename, self.x, self.y).generate()
+                return ImageThumbnailer(asset.open(), self.x, self.y).generate()
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+class LRUCache(object):
+    def __init__(self, limit=None, sizeof=None):
+        self.limit = limit
+        self.sizeof = sizeof if sizeof is not None else (lambda v: 1)
+        self.size = 0
+        self.content = OrderedDict()
+        self.lock = threading.RLock()
+
+    def __contains__(self, k):
+        with self.lock:
+            return k in self.content
+
+    def __len__(self):
+        with self.lock:
+            return len(self.content)
+
+    def __getitem__(self, k):
+        with self.lock:
+            v, size = self.content.pop(k)
+            self.content[k] = (v, size)
+            return v
+
+    def __setitem__(self, k, v):
+        with self.lock:
+            if k in self.content:
+                self.size -= self.content.pop(k)[1]
+            size = self.sizeof(v)
+            if self.limit is not None and size > self.limit:
+                return
+            self.content[k] = (v, size)
+            self.size += size
+            self.evict()
+
+    def get(self, k, default=None):
+        try:
+            return self[k]
+        except KeyError:
+            return default
+
+    def fits(self, v):
+        return self.limit is None or self.sizeof(v) <= self.limit
+
+    def resize(self, limit):
+        with self.lock:
+            self.limit = limit
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            while self.limit is not None and self.size > self.limit:
+                k, (v, size) = self.content.popitem(last=False)
+                self.size -= size
+
+    def clear(self):
+        with self.lock:
+            self.content.clear()
+            self.size = 0
+
+class DiskCache(object):
+    RESCAN_INTERVAL = 256
+    GRACE = 0
+    SIDECARS = ()
+
+    def __init__(self, path, limit=None):
+        self.path = path
+        self.limit = limit
+        self.size = None
+        self.puts = 0
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        self._touch(path)
+        return data
+
+    def lookup(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        self._touch(path)
+        return path
+
+    def put(self, key, data):
+        return self.put_stream(key, [data])
+
+    def put_stream(self, key, chunks, digest=None):
+        path = self._path(key)
+        parent = os.path.dirname(path)
+        try:
+            os.mkdir(parent)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp = tempfile.mkstemp(dir=parent, prefix='.tmp')
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    if digest is not None:
+                        digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            if digest is not None and digest.hexdigest() != key:
+                raise ValueError(u'digest mismatch for %s (%s)' % (key, digest.hexdigest()))
+            os.rename(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+        self._account(size)
+        return path
+
+    def evict(self):
+        if self.limit is None:
+            return
+        with self._locked():
+            entries = []
+            for parent in os.listdir(self.path):
+                parent = os.path.join(self.path, parent)
+                if not os.path.isdir(parent):
+                    continue
+                for name in os.listdir(parent):
+                    if name.startswith('.') or name.endswith(self.SIDECARS):
+                        continue
+                    path = os.path.join(parent, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+            self.size = sum(size for _, size, _ in entries)
+            entries.sort()
+            horizon = time.time() - self.GRACE
+            for mtime, size, path in entries:
+                if self.size <= self.limit or mtime > horizon:
+                    break
+                log.debug((u'evicting %s' % path).encode('UTF-8'))
+                for path in [path] + [path + suffix for suffix in self.SIDECARS]:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                self.size -= size
+
+    def _account(self, size):
+        if self.limit is None:
+            return
+        self.puts += 1
+        if self.size is not None:
+            self.size += size
+        if self.size is None or self.size > self.limit or self.puts % self.RESCAN_INTERVAL == 0:
+            self.evict()
+
+    def _path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def _touch(self, path):
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(os.path.join(self.path, '.lock'), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+class SQLiteCache(object):
+    TIMEOUT = 30.0
+
+    def __init__(self, path, limit=None):
+        self.path = path
+        self.limit = limit
+        self.local = threading.local()
+
+    def get(self, key):
+        conn = self._conn()
+        with conn:
+            row = conn.execute(u'select value from cache where key=?', (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute(u'update cache set atime=? where key=?', (time.time(), key))
+        return str(row[0])
+
+    def put(self, key, data):
+        conn = self._conn()
+        with conn:
+            conn.execute(u'insert or replace into cache (key, value, size, atime) values (?,?,?,?)', (key, buffer(data), len(data), time.time()))
+        self.evict()
+
+    def evict(self):
+        if self.limit is None:
+            return
+        conn = self._conn()
+        with conn:
+            size = conn.execute(u'select coalesce(sum(size), 0) from cache').fetchone()[0]
+            if size <= self.limit:
+                return
+            victims = []
+            for key, entry in conn.execute(u'select key, size from cache order by atime'):
+                if size <= self.limit:
+                    break
+                victims.append((key,))
+                size -= entry
+            log.debug(u'evicting %d entries from %s' % (len(victims), self.path))
+            conn.executemany(u'delete from cache where key=?', victims)
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=self.TIMEOUT)
+            with conn:
+                conn.execute(u'create table if not exists cache (key varchar primary key, value blob, size integer, atime real)')
+                conn.execute(u'create index if not exists cache_atime on cache (atime)')
+        return conn
+
+class TieredCache(LRUCache):
+    def __init__(self, limit=None, sizeof=None):
+        super(TieredCache, self).__init__(limit, sizeof)
+        self.disk = None
+
+    def persist(self, path, limit=None):
+        if path is not None:
+            self.disk = DiskCache(path, limit)
+        else:
+            self.disk = None
+
+    def lookup(self, key):
+        value = self.get(key)
+        if value is None and self.disk is not None:
+            data = self.disk.get(self._digest(key))
+            if data is not None:
+                value = self.load(data)
+                self[key] = value
+        return value
+
+    def store(self, key, value):
+        self[key] = value
+        if self.disk is not None:
+            self.disk.put(self._digest(key), self.dump(value))
+
+    def dump(self, value):
+        raise NotImplementedError
+
+    def load(self, data):
+        raise NotImplementedError
+
+    def _digest(self, key):
+        return hashlib.sha256(repr(key)).hexdigest()
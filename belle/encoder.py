@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import struct
+import zlib
+import Image
+
+class ChunkWriter(object):
+    # Hides fileno() so PIL hands over each encoded block through write() instead of writing to the descriptor itself.
+    def __init__(self, to):
+        self.to = to
+
+    def write(self, data):
+        self.to.write(data)
+
+    def flush(self):
+        if hasattr(self.to, 'flush'):
+            self.to.flush()
+
+class Encoder(object):
+    FORMATS = dict(PNG='image/png', JPEG='image/jpeg', WEBP='image/webp')
+    ALIASES = dict(JPG='JPEG')
+    STRIP_HEIGHT = 64
+
+    def __init__(self, format='PNG', compress_level=6, filter=None, quality=75, progressive=False):
+        format = format.upper()
+        self.format = self.ALIASES.get(format, format)
+        self.compress_level = compress_level
+        self.filter = filter
+        self.quality = quality
+        self.progressive = progressive
+
+        Image.init()
+        if self.format not in self.FORMATS or self.format not in Image.SAVE:
+            raise ValueError(u'unsupported format: %s' % format)
+        if filter is not None and filter not in PNGStreamWriter.FILTERS:
+            raise ValueError(u'unknown PNG filter: %s' % filter)
+
+    @property
+    def content_type(self):
+        return self.FORMATS[self.format]
+
+    def key(self):
+        return (self.format, self.compress_level, self.filter, self.quality, self.progressive)
+
+    def with_format(self, format):
+        return Encoder(format, self.compress_level, self.filter, self.quality, self.progressive)
+
+    def encode(self, im, to):
+        im = self._prepare(im)
+        if self.format == 'PNG' and self.filter is not None:
+            out = self.strip_writer(to, im.size[0], im.size[1], im.mode)
+            for top in xrange(0, im.size[1], self.STRIP_HEIGHT):
+                out.write(im.crop((0, top, im.size[0], min(top + self.STRIP_HEIGHT, im.size[1]))))
+            out.close()
+        elif self.format == 'PNG':
+            im.save(ChunkWriter(to), format='PNG', compress_level=self.compress_level)
+        elif self.format == 'JPEG':
+            im.save(ChunkWriter(to), format='JPEG', quality=self.quality, progressive=self.progressive)
+        else:
+            im.save(ChunkWriter(to), format=self.format, quality=self.quality)
+
+    def strip_writer(self, to, width, height, mode='RGBA'):
+        if self.format != 'PNG':
+            raise ValueError(u'strip output is only supported for PNG')
+        return PNGStreamWriter(to, width, height, mode, self.compress_level, self.filter or 'none')
+
+    def _prepare(self, im):
+        if self.format == 'JPEG':
+            return im.convert('RGB')
+        if im.mode == 'RGBA' and im.getextrema()[3][0] == 255:
+            return im.convert('RGB')
+        return im
+
+class PNGStreamWriter(object):
+    SIGNATURE = '\x89PNG\r\n\x1a\n'
+    COLOR_TYPES = dict(L=(0, 1), RGB=(2, 3), RGBA=(6, 4))
+    FILTERS = dict(none=0, sub=1, up=2, average=3, paeth=4)
+
+    def __init__(self, to, width, height, mode='RGBA', compress_level=6, filter='none'):
+        self.to = to
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.color_type, self.bpp = self.COLOR_TYPES[mode]
+        self.compressor = zlib.compressobj(compress_level)
+        self.filter = self.FILTERS[filter]
+        self.rows = 0
+        self.previous = None
+        if self.filter:
+            import numpy
+            self.numpy = numpy
+
+        self.to.write(self.SIGNATURE)
+        self._chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, self.color_type, 0, 0, 0))
+
+    def write(self, im):
+        if im.mode != self.mode:
+            im = im.convert(self.mode)
+        if im.size[0] != self.width:
+            raise ValueError(u'strip width mismatch (%d != %d)' % (im.size[0], self.width))
+        raw = im.tostring()
+        stride = self.width * self.bpp
+        if self.filter:
+            data = self._filter(raw, im.size[1], stride)
+        else:
+            data = ''.join(['\x00' + raw[i:i + stride] for i in xrange(0, len(raw), stride)])
+        self._idat(self.compressor.compress(data))
+        self.rows += im.size[1]
+
+    def close(self):
+        if self.rows != self.height:
+            raise ValueError(u'image height mismatch (%d != %d)' % (self.rows, self.height))
+        self._idat(self.compressor.flush())
+        self._chunk('IEND', '')
+
+    def _filter(self, raw, rows, stride):
+        np = self.numpy
+        x = np.frombuffer(raw, np.uint8).reshape(rows, stride).astype(np.int16)
+        up = np.empty_like(x)
+        up[0] = self.previous if self.previous is not None else 0
+        up[1:] = x[:-1]
+        self.previous = x[-1].copy()
+        left = np.zeros_like(x)
+        left[:, self.bpp:] = x[:, :-self.bpp]
+        if self.filter == 1:
+            predictor = left
+        elif self.filter == 2:
+            predictor = up
+        elif self.filter == 3:
+            predictor = (left + up) >> 1
+        else:
+            upleft = np.zeros_like(x)
+            upleft[:, self.bpp:] = up[:, :-self.bpp]
+            p = left + up - upleft
+            pa, pb, pc = np.abs(p - left), np.abs(p - up), np.abs(p - upleft)
+            predictor = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, upleft))
+        out = np.empty((rows, stride + 1), np.uint8)
+        out[:, 0] = self.filter
+        out[:, 1:] = (x - predictor) & 0xff
+        return out.tostring()
+
+    def _idat(self, data):
+        if data:
+            self._chunk('IDAT', data)
+
+    def _chunk(self, type, data):
+        self.to.write(struct.pack('>I', len(data)))
+        self.to.write(type)
+        self.to.write(data)
+        self.to.write(struct.pack('>I', zlib.crc32(type + data) & 0xffffffff))
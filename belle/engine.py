@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import Image, ImageDraw
+
+class PILEngine(object):
+    def colorize(self, size, layers):
+        out = Image.new("RGBA", size, (0,0,0,0))
+        draw = ImageDraw.Draw(out)
+        for mask, offset, color in layers:
+            draw.bitmap(offset, mask, color)
+        return out
+
+    def blend(self, im, sprites, origin=(0, 0)):
+        for (sprite, (x, y)), opaque in sprites:
+            if opaque:
+                im.paste(sprite, (x - origin[0], y - origin[1]))
+            else:
+                im.paste(sprite, (x - origin[0], y - origin[1]), sprite)
+        return im
+
+class NumPyEngine(object):
+    def __init__(self):
+        import numpy
+        self.numpy = numpy
+
+    def colorize(self, size, layers):
+        out = self.numpy.zeros((size[1], size[0], 4), self.numpy.uint8)
+        for mask, (x, y), color in layers:
+            self._lerp(out, self.numpy.array(color, self.numpy.uint8), self._array(mask), x, y)
+        return self._image(out, "RGBA")
+
+    def blend(self, im, sprites, origin=(0, 0)):
+        out = self._array(im).copy()
+        for (sprite, (x, y)), opaque in sprites:
+            pixels = self._array(sprite)
+            if opaque:
+                self._copy(out, pixels, x - origin[0], y - origin[1])
+            else:
+                self._lerp(out, pixels, pixels[..., 3:], x - origin[0], y - origin[1])
+        return self._image(out, im.mode)
+
+    def _array(self, im):
+        if not im.size[0] or not im.size[1]:
+            # PIL can't encode an empty image (e.g. the bitmap of a space); there is nothing to draw anyway.
+            return self.numpy.zeros((im.size[1], im.size[0], len(im.mode)), self.numpy.uint8)
+        return self.numpy.frombuffer(im.tostring(), self.numpy.uint8).reshape(im.size[1], im.size[0], len(im.mode))
+
+    def _image(self, pixels, mode):
+        if not pixels.shape[0] or not pixels.shape[1]:
+            return Image.new(mode, (pixels.shape[1], pixels.shape[0]))
+        return Image.fromstring(mode, (pixels.shape[1], pixels.shape[0]), pixels.tostring())
+
+    def _clip(self, out, src, x, y):
+        height, width = src.shape[:2]
+        left, top = max(x, 0), max(y, 0)
+        right, bottom = min(x + width, out.shape[1]), min(y + height, out.shape[0])
+        if left >= right or top >= bottom:
+            return None
+        return (slice(top, bottom), slice(left, right)), (slice(top - y, bottom - y), slice(left - x, right - x))
+
+    def _copy(self, out, src, x, y):
+        clip = self._clip(out, src, x, y)
+        if clip is not None:
+            dst, src_ = clip
+            out[dst] = src[src_]
+
+    def _lerp(self, out, src, mask, x, y):
+        clip = self._clip(out, mask, x, y)
+        if clip is None:
+            return
+        dst, src_ = clip
+        mask = mask[src_].astype(self.numpy.uint32)
+        if src.ndim == 3:
+            src = src[src_]
+        # Same rounding as PIL's paste, so both engines agree to the pixel.
+        v = out[dst] * (255 - mask) + src * mask + 128
+        out[dst] = ((v >> 8) + v) >> 8
+
+ENGINES = dict(pil=PILEngine, numpy=NumPyEngine)
+
+current = PILEngine()
+
+def use(name):
+    global current
+    try:
+        current = ENGINES[name]()
+    except KeyError:
+        raise ValueError(u'unknown engine: %s' % name)
@@ -1,59 +1,152 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
+import collections
+import cPickle
+import ctypes
 import logging
 import math
 import re
-import struct
 import sys
 import unicodedata
 
 import freetype
 import Image, ImageDraw
 
+from belle import engine, stats
+from belle.cache import LRUCache, TieredCache
+
 log = logging.getLogger(__name__)
 
+class FaceCache(LRUCache):
+    LIMIT = 32
+
+    def __init__(self, limit=LIMIT):
+        super(FaceCache, self).__init__(limit)
+
+    def face(self, asset, index, size):
+        key = (asset.key or asset.filename, int(index), size)
+        with self.lock:
+            face = self.get(key)
+            if face is None:
+                stats.count('glyph.face.miss')
+                log.debug((u'loading face %s (%s) at %d' % (key[0], index, size)).encode('UTF-8'))
+                with stats.timer('glyph.face.load'):
+                    if asset.data is not None:
+                        face = freetype.Face(MemoryFont(asset.data), index=int(index))
+                    else:
+                        face = freetype.Face(asset.filename, index=int(index))
+                    face.set_char_size(size)
+                self[key] = face
+            else:
+                stats.count('glyph.face.hit')
+            return face
+
+faces = FaceCache()
+
+class MemoryFont(object):
+    # freetype-py hands read()'s result to FT_New_Memory_Face as is (no argtypes), so a ctypes view of a pack
+    # reaches FreeType as a pointer into the mapping rather than a copy; the Face keeps it alive in _filebodys.
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+class GlyphCache(TieredCache):
+    LIMIT = 64 * 1024 * 1024
+
+    def __init__(self, limit=LIMIT):
+        super(GlyphCache, self).__init__(limit, sizeof=lambda v: len(v[0].mode) * v[0].size[0] * v[0].size[1])
+
+    def dump(self, value):
+        im, offset, geom, metrics = value
+        return cPickle.dumps((im.mode, im.size, im.tostring(), offset, geom, metrics), 2)
+
+    def load(self, data):
+        mode, size, pixels, offset, geom, metrics = cPickle.loads(data)
+        return (Image.fromstring(mode, size, pixels), offset, geom, metrics)
+
+glyphs = GlyphCache()
+
 class FT2Bitmap(object):
     def __init__(self, bitmap):
         self.bitmap = bitmap
 
     def to_pil_image(self):
-        data = ''.join([struct.pack('B', c) for c in self.bitmap.buffer])
-        return Image.frombuffer("L", (self.bitmap.width, self.bitmap.rows), data, "raw", "L", abs(self.bitmap.pitch), 1)
+        bitmap = self.bitmap._FT_Bitmap
+        pitch = bitmap.pitch
+        if not bitmap.rows or not pitch:
+            return Image.new("L", (bitmap.width, bitmap.rows), 0)
+        # FreeType owns the buffer and frees it with the glyph, so take it in one memcpy instead of per pixel.
+        data = ctypes.string_at(bitmap.buffer, bitmap.rows * abs(pitch))
+        # Negative pitch means the buffer starts at the bottom-most row.
+        return Image.frombuffer("L", (bitmap.width, bitmap.rows), data, "raw", "L", abs(pitch), 1 if pitch > 0 else -1)
 
 class GlyphWriter(object):
     OVERRENDER_RATIO = 1.1
 
+    static = False
+
     def __init__(self, char):
         self.char = char
         
-    def write(self, to, mapping=None):
+    def write(self, to, mapping=None, origin=(0, 0)):
+        glyph_, (x, y) = self.render(mapping)
+        to.paste(glyph_, (x - origin[0], y - origin[1]), glyph_)
+
+    def render(self, mapping=None):
         if mapping is None:
             if self.char.pivot == 'center':
                 mapping = NormalMapping
             else:
                 mapping = LeftTopMapping
-        glyph_, offset = self._composite(self._load_glyph(), self._load_glyph_outline())
+        glyph_, offset = self._rasterize()
         coord = mapping(self.char.height).map(self.char, glyph_)
-        to.paste(glyph_, (int(coord[0] + offset[0]), int(coord[1] + offset[1])), glyph_)
+        return glyph_, (int(coord[0] + offset[0]), int(coord[1] + offset[1]))
+
+    def bbox(self, mapping=None):
+        glyph_, (x, y) = self.render(mapping)
+        return (x, y, x + glyph_.size[0], y + glyph_.size[1])
+
+    def signature(self):
+        return (self.__class__.__name__, self.char.cache_key(), self.char.x, self.char.y, self.char.pivot)
+
+    def opaque_box(self):
+        return None
+
+    def _rasterize(self):
+        key = self.char.cache_key()
+        cached = glyphs.lookup(key)
+        if cached is not None:
+            stats.count('glyph.cache.hit')
+            glyph_, offset, geom, metrics = cached
+            self.char.set_bitmap_geom(geom)
+            self.char.restore_metrics(metrics)
+            return glyph_, offset
+        stats.count('glyph.cache.miss')
+        fill_glyph, outline_glyph = self._load_glyph()
+        with stats.timer('glyph.composite'):
+            glyph_, offset = self._composite(fill_glyph, outline_glyph)
+        glyphs.store(key, (glyph_, offset, self.char.get_bitmap_geom(), self.char.get_metrics()))
+        return glyph_, offset
 
     def _composite(self, fill_glyph, outline_glyph):
         size = (1, 1)
         offset = (0, 0)
         if self.char.is_filled():
-            fill_mask = self._write_glyph(self._load_glyph())
+            fill_mask = self._write_glyph(fill_glyph)
             size = map(max, size, fill_mask.size)
         if self.char.is_outlined():
-            outline_mask = self._write_glyph(self._load_glyph_outline())
+            outline_mask = self._write_glyph(outline_glyph)
             size = map(max, size, outline_mask.size)
 
-        out = Image.new("RGBA", [int(x * self.OVERRENDER_RATIO) for x in size], (0,0,0,0))
-        draw = ImageDraw.Draw(out)
-
+        layers = []
         if self.char.is_outlined():
-            draw.bitmap((0, 0), outline_mask, self.char.outline_color)
+            layers.append((outline_mask, (0, 0), self.char.outline_color))
         if self.char.is_filled():
-            draw.bitmap((self.char.outline_width, self.char.outline_width), fill_mask, self.char.color)
+            layers.append((fill_mask, (self.char.outline_width or 0, self.char.outline_width or 0), self.char.color))
+        out = engine.current.colorize([int(x * self.OVERRENDER_RATIO) for x in size], layers)
 
         if self.char.rotation:
             original = (out.size[0] / 2, out.size[1] / 2)
@@ -72,14 +165,21 @@ class GlyphWriter(object):
         return out, offset
         
     def _load_glyph(self):
-        face = freetype.Face(self.char.face, index=self.char.index)
-        face.set_char_size(int(self.char.height * 64))
-        face.load_char(self.char.char, freetype.FT_LOAD_DEFAULT | freetype.FT_LOAD_NO_BITMAP)
-        self.char.set_metrics(face)
-        return face.glyph.get_glyph()
-
-    def _load_glyph_outline(self):
-        glyph = self._load_glyph()
+        fill_glyph = outline_glyph = None
+        with faces.lock:
+            face = faces.face(self.char.face, self.char.index, int(self.char.height * 64))
+            face.load_char(self.char.char, freetype.FT_LOAD_DEFAULT | freetype.FT_LOAD_NO_BITMAP)
+            self.char.set_metrics(face)
+            if self.char.is_filled():
+                fill_glyph = face.glyph.get_glyph()
+            if self.char.is_outlined():
+                outline_glyph = face.glyph.get_glyph()
+        if outline_glyph is not None:
+            with stats.timer('glyph.stroke'):
+                outline_glyph = self._load_glyph_outline(outline_glyph)
+        return fill_glyph, outline_glyph
+
+    def _load_glyph_outline(self, glyph):
         stroker = freetype.Stroker()
         stroker.set(int(self.char.outline_width * 64), freetype.FT_STROKER_LINECAP_ROUND, freetype.FT_STROKER_LINEJOIN_ROUND, 0 )
         glyph.stroke(stroker)
@@ -99,7 +199,8 @@ class Character(object):
         self.width = width
         self.height = height
         self.rotation = rotation
-        self.face = face.filename
+        self.face = face
+        self.face_key = getattr(face, 'key', None) or face.filename
         self.index = index
         self.color = color
         self.outline_color = outline_color
@@ -131,6 +232,12 @@ class Character(object):
         metrics = face.glyph._FT_GlyphSlot.contents.metrics
         self._metrics = dict(height=metrics.height, horiBearingY=metrics.horiBearingY, ascender=face.ascender*face.size.x_scale / 65536.0, descender=face.descender*face.size.y_scale / 65536.0)
 
+    def restore_metrics(self, metrics):
+        self._metrics = metrics
+
+    def cache_key(self):
+        return (self.face_key, int(self.index), self.char, self.height, self.outline_width, self.color, self.outline_color, self.rotation, self.tate)
+
     def is_outlined(self):
         return self.outline_color is not None and self.outline_width is not None
 
@@ -140,9 +247,54 @@ class Character(object):
     @property
     def policy(self):
         if self.tate:
-            return TategakiGlyphPolicy(self.char)
+            return tategaki_policies[self.char]
         else:
-            return YokogakiGlyphPolicy(self.char)
+            return yokogaki_policies[self.char]
+
+class TextRun(object):
+    def __init__(self, text=None, x=None, y=None, height=None, face=None, color=None, outline_color=None, outline_width=None, tate=False, index=0):
+        self.text = text
+        self.x = x
+        self.y = y
+        self.height = height
+        self.face = face
+        self.color = color
+        self.outline_color = outline_color
+        self.outline_width = outline_width
+        self.tate = tate
+        self.index = index
+
+    def characters(self):
+        chars = []
+        for char, (x, y) in zip(self.text, self.layout()):
+            if char.isspace():
+                continue
+            chars.append(Character(char=char, x=x, y=y, width=self.height, height=self.height, rotation=0.0,
+                                   face=self.face, color=self.color, outline_color=self.outline_color, outline_width=self.outline_width,
+                                   tate=self.tate, index=self.index))
+        return chars
+
+    def layout(self):
+        x, y = self.x, self.y
+        positions = []
+        with faces.lock:
+            face = faces.face(self.face, self.index, int(self.height * 64))
+            kerning = not self.tate and face.has_kerning
+            previous = 0
+            for char in self.text:
+                index = face.get_char_index(char)
+                if kerning and previous and index:
+                    x += face.get_kerning(previous, index).x / 64.0
+                positions.append((int(x), int(y)))
+                face.load_glyph(index, freetype.FT_LOAD_DEFAULT | freetype.FT_LOAD_NO_BITMAP)
+                if not self.tate:
+                    x += face.glyph.metrics.horiAdvance / 64.0
+                elif face.has_vertical:
+                    y += face.glyph.metrics.vertAdvance / 64.0
+                else:
+                    y += self.height
+                previous = index
+        return positions
 
 class LeftTopMapping(object):
     TATE_NAKA_YOKO_BASELINE_ADJ = 0.5
@@ -235,7 +387,7 @@ class TategakiGlyphPolicy(GlyphPolicy):
     def should_transpose(self):
         if self.should_rotate:
             return True
-        return self.should_flush()
+        return self.should_flush
 
     @property
     def should_realign_to_center(self):
@@ -253,3 +405,21 @@ class TategakiGlyphPolicy(GlyphPolicy):
             if self.category.startswith(u'P'):
                 return True
         return False
+
+GlyphLayout = collections.namedtuple('GlyphLayout', 'should_rotate should_transpose should_realign_to_center should_flush')
+
+class GlyphPolicyTable(object):
+    def __init__(self, policy):
+        self.policy = policy
+        self.table = dict()
+
+    def __getitem__(self, char):
+        try:
+            return self.table[char]
+        except KeyError:
+            policy = self.policy(char)
+            layout = self.table[char] = GlyphLayout(policy.should_rotate, policy.should_transpose, policy.should_realign_to_center, policy.should_flush)
+            return layout
+
+yokogaki_policies = GlyphPolicyTable(YokogakiGlyphPolicy)
+tategaki_policies = GlyphPolicyTable(TategakiGlyphPolicy)
@@ -1,32 +1,117 @@
 from __future__ import print_function
 
+import cPickle
+import math
 import re
 import struct
 import sys
+import zlib
 import freetype
 import Image, ImageDraw
 
+from belle import stats
+from belle.cache import TieredCache
+
+class ImageCache(TieredCache):
+    LIMIT = 256 * 1024 * 1024
+
+    def __init__(self, limit=LIMIT):
+        super(ImageCache, self).__init__(limit, sizeof=lambda im: len(im.mode) * im.size[0] * im.size[1])
+
+    def dump(self, im):
+        return cPickle.dumps((im.mode, im.size, zlib.compress(im.tostring(), 1)), 2)
+
+    def load(self, data):
+        mode, size, pixels = cPickle.loads(data)
+        return Image.fromstring(mode, size, zlib.decompress(pixels))
+
+images = ImageCache()
+
 class Img(object):
-    def __init__(self, src=None, x=None, y=None, width=None, height=None, rotation=None):
-        self.src = src.filename
+    def __init__(self, src=None, x=None, y=None, width=None, height=None, rotation=None, draft=False):
+        self.src = src
+        self.src_key = getattr(src, 'key', None) or src.filename
         self.x = x
         self.y = y
         self.width = width
         self.height = height
         self.rotation = rotation
+        self.draft = draft
+
+    def cache_key(self):
+        return (self.src_key, self.width, self.height, self.rotation, self.draft)
 
 class ImgWriter(object):
+    OPAQUE_MODES = ('1', 'L', 'P', 'I', 'F', 'RGB', 'CMYK', 'YCbCr')
+
+    static = True
+
     def __init__(self, img):
         self.img = img
+        self._opaque = None
+
+    def write(self, to, origin=(0, 0)):
+        im, (paste_x, paste_y) = self.render()
+        to.paste(im, (paste_x - origin[0], paste_y - origin[1]), im)
 
-    def write(self, to):
-        im = Image.open(self.img.src).convert('RGBA')
+    def render(self):
+        key = self.img.cache_key()
+        im = images.lookup(key)
+        if im is None:
+            stats.count('image.cache.miss')
+            with stats.timer('image.transform'):
+                im = self._transform()
+            images.store(key, im)
+        else:
+            stats.count('image.cache.hit')
+
+        paste_x = self.img.x - im.size[0]/2
+        paste_y = self.img.y - im.size[1]/2
+        return im, (paste_x, paste_y)
+
+    def _transform(self):
+        im = Image.open(self.img.src.open())
+        if self.img.draft:
+            im.draft('RGB', (self.img.width, self.img.height))
+        im = im.convert('RGBA')
         if self.img.width != im.size[0] or self.img.height != im.size[1]:
             im = im.resize((self.img.width, self.img.height), resample=Image.ANTIALIAS)
         if self.img.rotation:
             im = im.rotate(-self.img.rotation, expand=1, resample=Image.BICUBIC)
+        return im
 
-        paste_x = self.img.x - im.size[0]/2
-        paste_y = self.img.y - im.size[1]/2
-        to.paste(im, (paste_x, paste_y), im)
+    def signature(self):
+        return (self.__class__.__name__, self.img.cache_key(), self.img.x, self.img.y)
+
+    def opaque_box(self):
+        if self.img.rotation % 360:
+            return None
+        if self._opaque is None:
+            try:
+                im = Image.open(self.img.src.open())
+                self._opaque = im.mode in self.OPAQUE_MODES and 'transparency' not in im.info
+            except IOError:
+                self._opaque = False
+        if not self._opaque:
+            return None
+        x = self.img.x - self.img.width/2
+        y = self.img.y - self.img.height/2
+        return (x, y, x + self.img.width, y + self.img.height)
+
+    def bbox(self):
+        w, h = self.size()
+        x = self.img.x - w/2
+        y = self.img.y - h/2
+        return (x - 1, y - 1, x + w + 1, y + h + 1)
+
+    def size(self):
+        w, h = self.img.width, self.img.height
+        if self.img.rotation:
+            angle = self.img.rotation * math.pi / 180
+            a, b = math.cos(angle), math.sin(angle)
+            xx = [a*x + b*y for x, y in ((0, 0), (w, 0), (w, h), (0, h))]
+            yy = [-b*x + a*y for x, y in ((0, 0), (w, 0), (w, h), (0, h))]
+            w = int(math.ceil(max(xx)) - math.floor(min(xx)))
+            h = int(math.ceil(max(yy)) - math.floor(min(yy)))
+        return w, h
 
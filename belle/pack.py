@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import binascii
+import ctypes
+import mmap
+import os
+import struct
+import tempfile
+
+class Pack(object):
+    MAGIC = 'BELLEPK1'
+    HEADER = struct.Struct('>8sI')
+    ENTRY = struct.Struct('>32sQQ32s')
+
+    def __init__(self, path):
+        self.path = path
+        self.index = self._map(path + '.idx', mmap.ACCESS_READ)
+        if self.index is None:
+            raise IOError(u'empty pack index: %s.idx' % path)
+        magic, self.count = self.HEADER.unpack_from(self.index, 0)
+        if magic != self.MAGIC:
+            raise IOError(u'not a pack index: %s.idx' % path)
+        # Copy-on-write so ctypes can point into the mapping; nothing ever writes to it, so pages stay shared.
+        self.data = self._map(path + '.pack', mmap.ACCESS_COPY)
+
+    def find(self, key):
+        try:
+            digest = binascii.unhexlify(key)
+        except (TypeError, ValueError):
+            return None
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self._entry(mid)
+            if entry[0] < digest:
+                lo = mid + 1
+            elif entry[0] > digest:
+                hi = mid
+            else:
+                return entry[1:]
+        return None
+
+    def get(self, key):
+        found = self.find(key)
+        if found is None:
+            return None
+        offset, length, type = found
+        if not length:
+            return type, ''
+        return type, (ctypes.c_char * length).from_buffer(self.data, offset)
+
+    def entries(self):
+        for i in xrange(self.count):
+            yield self._entry(i)
+
+    def _entry(self, i):
+        digest, offset, length, type = self.ENTRY.unpack_from(self.index, self.HEADER.size + i * self.ENTRY.size)
+        return digest, offset, length, type.rstrip('\0').decode('UTF-8')
+
+    def _map(self, path, access):
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return None
+            return mmap.mmap(f.fileno(), 0, access=access)
+
+class PackWriter(object):
+    def __init__(self, path):
+        self.path = path
+        self.entries = dict()
+        if os.path.exists(path + '.idx'):
+            with open(path + '.idx', 'rb') as f:
+                index = f.read()
+            magic, count = Pack.HEADER.unpack_from(index, 0)
+            if magic != Pack.MAGIC:
+                raise IOError(u'not a pack index: %s.idx' % path)
+            for i in xrange(count):
+                digest, offset, length, type = Pack.ENTRY.unpack_from(index, Pack.HEADER.size + i * Pack.ENTRY.size)
+                self.entries[digest] = (offset, length, type)
+        self.end = max([offset + length for offset, length, type in self.entries.itervalues()] or [0])
+        self.out = open(path + '.pack', 'r+b' if os.path.exists(path + '.pack') else 'w+b')
+        # Anything past the last indexed blob was left by an interrupted run.
+        self.out.truncate(self.end)
+        self.out.seek(self.end)
+
+    def __contains__(self, key):
+        return binascii.unhexlify(key) in self.entries
+
+    def append(self, key, type, data):
+        self.append_stream(key, type, [data])
+
+    def append_stream(self, key, type, chunks):
+        length = 0
+        try:
+            for chunk in chunks:
+                self.out.write(chunk)
+                length += len(chunk)
+        except:
+            # Drop the partial blob; it was never indexed.
+            self.out.truncate(self.end)
+            self.out.seek(self.end)
+            raise
+        self.entries[binascii.unhexlify(key)] = (self.end, length, type.encode('UTF-8')[:32])
+        self.end += length
+
+    def commit(self):
+        self.out.flush()
+        os.fsync(self.out.fileno())
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(Pack.HEADER.pack(Pack.MAGIC, len(self.entries)))
+                for digest in sorted(self.entries):
+                    f.write(Pack.ENTRY.pack(digest, *self.entries[digest]))
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp, 0644)
+            os.rename(tmp, self.path + '.idx')
+        except:
+            os.remove(tmp)
+            raise
+
+    def close(self):
+        try:
+            self.commit()
+        finally:
+            self.out.close()
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+import copy
+import difflib
+import hashlib
+import itertools
+import logging
+import threading
+import xml.etree.ElementTree as ET
+import Image
+
+from belle import engine
+from belle.cache import DiskCache, LRUCache, SQLiteCache
+
+log = logging.getLogger(__name__)
+
+class PageCache(object):
+    ASSET_ATTRIBUTES = ('src', 'face')
+
+    def __init__(self):
+        self.store = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def persist(self, url, limit=None):
+        if url is None:
+            self.store = None
+        elif url.startswith('sqlite:'):
+            self.store = SQLiteCache(url[7:], limit)
+        else:
+            self.store = DiskCache(url, limit)
+
+    def key(self, source, root, size, encoding):
+        from belle.asset import AssetFactoryBase
+
+        root = copy.deepcopy(root)
+        for elem in root.iter():
+            if elem.text is not None and not elem.text.strip() and len(elem):
+                elem.text = None
+            if elem.tail is not None and not elem.tail.strip():
+                elem.tail = None
+            for name in self.ASSET_ATTRIBUTES:
+                if name in elem.attrib:
+                    elem.attrib[name] = AssetFactoryBase.KEY_EXTRACTOR.sub(u'\g<1>', elem.attrib[name])
+        if source is not None:
+            # Tunables in the fragment don't change what the store serves.
+            source = source.partition('#')[0]
+        return hashlib.sha256(repr((source, ET.tostring(root, encoding='UTF-8'), size, encoding))).hexdigest()
+
+    def get(self, key):
+        if self.store is None:
+            return None
+        data = self.store.get(key)
+        with self.lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def put(self, key, data):
+        if self.store is not None:
+            self.store.put(key, data)
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses)
+
+pages = PageCache()
+
+class FlattenedLayerCache(LRUCache):
+    LIMIT = 128 * 1024 * 1024
+
+    def __init__(self, limit=LIMIT):
+        super(FlattenedLayerCache, self).__init__(limit, sizeof=lambda im: len(im.mode) * im.size[0] * im.size[1])
+
+flattened = FlattenedLayerCache()
+
+class Page(object):
+    BACKGROUND = (255,255,255,255)
+    STRIP_HEIGHT = 256
+
+    def __init__(self, width, height, layers=None):
+        self.width = width
+        self.height = height
+        self.layers = layers if layers is not None else []
+        self._plan = None
+        self._boxes = None
+
+    @property
+    def elements(self):
+        for layer in self.layers:
+            for element in layer:
+                yield element
+
+    def plan(self, elements=None):
+        if elements is None:
+            if self._plan is None:
+                self._plan = self.plan(list(self.elements))
+            return self._plan
+
+        covers = []
+        for i, element in enumerate(elements):
+            cover = element.opaque_box()
+            if cover is not None:
+                covers.append((i, self._clip(cover)))
+
+        plan = []
+        last = covers[-1][0] if covers else -1
+        for i, element in enumerate(elements):
+            if i < last:
+                box = self._clip(element.bbox())
+                if any(j > i and self._contains(cover, box) for j, cover in covers):
+                    log.debug('culling occluded %r' % (element.signature(),))
+                    continue
+            plan.append((element, element.opaque_box() is not None))
+        return plan
+
+    def boxes(self):
+        if self._boxes is None:
+            self._boxes = [(element, element.bbox(), opaque) for element, opaque in self.plan()]
+        return self._boxes
+
+    def render(self, workers=None):
+        base, plan, shared = self._flatten()
+        if workers is None:
+            if base is not None:
+                im = base.copy() if shared else base
+            else:
+                im = Image.new('RGBA', (self.width, self.height), self.BACKGROUND)
+            im = engine.current.blend(im, ((element.render(), opaque) for element, opaque in plan))
+        else:
+            im = Image.new('RGBA', (self.width, self.height), self.BACKGROUND)
+            for top, strip in self._parallel_strips(self.STRIP_HEIGHT, workers, base, plan):
+                im.paste(strip, (0, top))
+        return im
+
+    def render_region(self, region, sprites=None, base=None, boxes=None):
+        left, top, right, bottom = region
+        if base is not None:
+            im = base.crop(region)
+            im.load()
+        else:
+            im = Image.new('RGBA', (right - left, bottom - top), self.BACKGROUND)
+        if boxes is None:
+            boxes = self.boxes()
+        return engine.current.blend(im, self._region_sprites(region, sprites, boxes), (left, top))
+
+    def _region_sprites(self, region, sprites, boxes):
+        for i, (element, box, opaque) in enumerate(boxes):
+            if not self._intersects(box, region):
+                continue
+            if sprites is not None:
+                sprite = sprites.get(i)
+                if sprite is None:
+                    sprite = sprites[i] = element.render()
+            else:
+                sprite = element.render()
+            yield sprite, opaque
+
+    def strips(self, height=STRIP_HEIGHT, workers=None):
+        if workers is not None:
+            for strip in self._parallel_strips(height, workers):
+                yield strip
+            return
+
+        sprites = dict()
+        boxes = self.boxes()
+        for top in xrange(0, self.height, height):
+            bottom = min(top + height, self.height)
+            yield top, self.render_region((0, top, self.width, bottom), sprites)
+            for i in [i for i in sprites if boxes[i][1][3] <= bottom]:
+                del sprites[i]
+
+    def _flatten(self):
+        static = []
+        for layer in self.layers:
+            if not layer or not all(element.static for element in layer):
+                break
+            static.extend(layer)
+        plan = self.plan()
+        if not static:
+            return None, plan, False
+
+        key = (self.width, self.height, tuple(element.signature() for element in static))
+        base = flattened.get(key)
+        shared = base is not None
+        if base is None:
+            # Cull among the static elements only, so the cached base does not depend on what later layers cover.
+            base = Image.new('RGBA', (self.width, self.height), self.BACKGROUND)
+            base = engine.current.blend(base, ((element.render(), opaque) for element, opaque in self.plan(static)))
+            # A base the cache can't hold is used once, so the caller may draw straight onto it.
+            shared = flattened.fits(base)
+            if shared:
+                flattened[key] = base
+        else:
+            log.debug('using flattened static layers')
+        static = set(id(element) for element in static)
+        return base, [(element, opaque) for element, opaque in plan if id(element) not in static], shared
+
+    def _parallel_strips(self, height, workers, base=None, plan=None):
+        from multiprocessing.pool import ThreadPool
+
+        if plan is None:
+            plan = self.plan()
+        pool = ThreadPool(workers)
+        try:
+            boxes = [(element, box, opaque) for (element, opaque), box in itertools.izip(plan, pool.map(lambda entry: entry[0].bbox(), plan))]
+            regions = [(0, top, self.width, min(top + height, self.height)) for top in xrange(0, self.height, height)]
+            sprites = dict()
+            # One strip per worker at a time; only the sprites those strips touch are rendered, and each is dropped after its last strip.
+            for i in xrange(0, len(regions), workers):
+                batch = regions[i:i + workers]
+                span = (0, batch[0][1], self.width, batch[-1][3])
+                pending = [j for j, (element, box, opaque) in enumerate(boxes) if j not in sprites and self._intersects(box, span)]
+                sprites.update(itertools.izip(pending, pool.map(lambda j: boxes[j][0].render(), pending)))
+                for region, im in itertools.izip(batch, pool.map(lambda region: self.render_region(region, sprites, base, boxes), batch)):
+                    yield region[1], im
+                for j in [j for j in sprites if boxes[j][1][3] <= span[3]]:
+                    del sprites[j]
+        finally:
+            pool.terminate()
+
+    def _clip(self, box):
+        return (max(box[0], 0), max(box[1], 0), min(box[2], self.width), min(box[3], self.height))
+
+    def _contains(self, outer, inner):
+        return outer[0] <= inner[0] and outer[1] <= inner[1] and inner[2] <= outer[2] and inner[3] <= outer[3]
+
+    def _intersects(self, box, region):
+        return box[0] < region[2] and region[0] < box[2] and box[1] < region[3] and region[1] < box[3]
+
+class IncrementalRenderer(object):
+    MAX_REGIONS = 16
+
+    def __init__(self):
+        self.image = None
+        self.entries = None
+        self.lock = threading.Lock()
+
+    def render(self, page, workers=None):
+        entries = [(element.signature(), box) for element, box, opaque in page.boxes()]
+        if self.image is None or self.image.size != (page.width, page.height):
+            self.image = page.render(workers=workers)
+        else:
+            for region in self._dirty(entries, page):
+                log.debug('re-rendering %r' % (region,))
+                self.image.paste(page.render_region(region), region[:2])
+        self.entries = entries
+        return self.image
+
+    def _dirty(self, entries, page):
+        matcher = difflib.SequenceMatcher(None, [s for s, _ in self.entries], [s for s, _ in entries], autojunk=False)
+        boxes = []
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag != 'equal':
+                boxes.extend(box for _, box in self.entries[i1:i2])
+                boxes.extend(box for _, box in entries[j1:j2])
+
+        regions = []
+        for left, top, right, bottom in boxes:
+            region = (max(left, 0), max(top, 0), min(right, page.width), min(bottom, page.height))
+            if region[0] < region[2] and region[1] < region[3]:
+                regions.append(region)
+        if len(regions) > self.MAX_REGIONS:
+            regions = [(min(r[0] for r in regions), min(r[1] for r in regions), max(r[2] for r in regions), max(r[3] for r in regions))]
+        return regions
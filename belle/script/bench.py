@@ -0,0 +1,213 @@
+import hashlib
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import Image, ImageDraw
+
+log = logging.getLogger(__name__)
+
+FONT_DIRS = ('/usr/share/fonts', '/usr/local/share/fonts', '/Library/Fonts', '/System/Library/Fonts', 'C:\\Windows\\Fonts')
+YOKO_TEXT = u'The quick brown fox jumps over the lazy dog 0123456789'
+TATE_TEXT = u'\u3042\u3044\u3046\u3048\u304a\u30fc\u3001\u3002\u300c\u300d\u5f37\u6575\u3068\u66f8\u3044\u3066\u53cb\u3068\u8aad\u3080'
+
+CASES = [
+    ('yoko', dict(layers=2, chars=200)),
+    ('tate', dict(layers=2, chars=200, tate=True)),
+    ('outlined', dict(layers=2, chars=200, outline=True)),
+    ('rotated', dict(layers=2, chars=200, rotate=True)),
+    ('image-heavy', dict(layers=4, chars=20, images=24)),
+]
+
+class Fixture(object):
+    IMAGES = ((1024, 768, 'RGB'), (640, 640, 'RGBA'), (2048, 1536, 'RGB'), (300, 200, 'RGBA'))
+
+    def __init__(self, path, fonts, seed=0):
+        self.path = path
+        self.url = 'sqlite:///%s' % os.path.join(path, 'assets.db')
+        self.fonts = []
+        self.images = []
+        self.random = random.Random(seed)
+
+        import sqlite3
+        conn = sqlite3.connect(os.path.join(path, 'assets.db'))
+        try:
+            conn.execute('create table asset (name varchar, hash varchar unique, type varchar, blob blob, path varchar)')
+            for font in fonts:
+                with open(font, 'rb') as f:
+                    self.fonts.append(self._insert(conn, f.read(), os.path.splitext(font)[1].lower(), 'font'))
+            for width, height, mode in self.IMAGES:
+                self.images.append(self._insert(conn, self._image(width, height, mode), '.png', 'image/png'))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def design(self, width=1240, height=1754, layers=1, chars=0, images=0, tate=False, outline=False, rotate=False):
+        import xml.etree.ElementTree as ET
+
+        text = TATE_TEXT if tate else YOKO_TEXT
+        root = ET.Element('design', width=str(width), height=str(height))
+        for i in xrange(layers):
+            layer = ET.SubElement(root, 'layer')
+            for j in xrange(images / layers):
+                ET.SubElement(layer, 'image', src=self.random.choice(self.images),
+                              x=repr(self.random.random()), y=repr(self.random.random()),
+                              width=repr(self.random.uniform(0.1, 0.6)), height=repr(self.random.uniform(0.1, 0.6)),
+                              rotate=repr(self.random.choice((0.0, 0.0, 15.0)) if rotate else 0.0))
+            for j in xrange(chars / layers):
+                attrib = dict(x=repr(self.random.random() * 0.95), y=repr(self.random.random() * 0.95),
+                              width='0.03', height='0.03', face=self.fonts[j % len(self.fonts)], color='#000000',
+                              rotate=repr(self.random.uniform(-45.0, 45.0) if rotate else 0.0))
+                if tate:
+                    attrib['tate'] = 'tate'
+                if outline:
+                    attrib.update({'outline-color': '#ffffff', 'outline-edge': '0.002'})
+                ET.SubElement(layer, 'char', **attrib).text = text[j % len(text)]
+        return root
+
+    def _insert(self, conn, blob, ext, type):
+        hash = hashlib.sha256(blob).hexdigest()
+        conn.execute('insert into asset (name, hash, type, blob) values (?, ?, ?, ?)', (hash + ext, hash, type, buffer(blob)))
+        return hash
+
+    def _image(self, width, height, mode):
+        import cStringIO
+
+        im = Image.new(mode, (width, height), (255, 255, 255, 0)[:len(mode)])
+        draw = ImageDraw.Draw(im)
+        for i in xrange(64):
+            x, y = self.random.randrange(width), self.random.randrange(height)
+            color = tuple(self.random.randrange(256) for c in mode)
+            draw.ellipse((x, y, x + self.random.randrange(width / 4), y + self.random.randrange(height / 4)), fill=color)
+        out = cStringIO.StringIO()
+        im.save(out, 'PNG')
+        return out.getvalue()
+
+def find_fonts(limit=2):
+    fonts = []
+    for top in FONT_DIRS:
+        for dirpath, dirnames, filenames in os.walk(top):
+            for filename in sorted(filenames):
+                if os.path.splitext(filename)[1].lower() in ('.ttf', '.otf', '.ttc'):
+                    fonts.append(os.path.join(dirpath, filename))
+                    if len(fonts) >= limit:
+                        return fonts
+    return fonts
+
+def reset_caches():
+    from belle.glyph import faces, glyphs
+    from belle.image import images
+    from belle.page import flattened
+
+    for cache in (faces, glyphs, images, flattened):
+        cache.clear()
+
+def measure(func, repeat):
+    runs = []
+    for i in xrange(repeat):
+        reset_caches()
+        started = time.time()
+        func()
+        runs.append(time.time() - started)
+    runs.sort()
+    return dict(min=runs[0], median=runs[len(runs) / 2], mean=sum(runs) / len(runs), runs=runs)
+
+def benchmarks(fixture):
+    from belle.asset import Asset, AssetFactory, AssetThumbnailGenerator
+    from belle.glyph import Character, GlyphWriter
+    from belle.script.render import _render, _render_thumbnail
+
+    for name, params in CASES:
+        root = fixture.design(**params)
+        yield 'render/%s' % name, lambda root=root: _render(fixture.url, root=root)
+        yield 'render-thumbnail/%s' % name, lambda root=root: _render_thumbnail(fixture.url, 256, 362, root=root)
+
+    generator = AssetThumbnailGenerator(fixture.url, 128, 128)
+    yield 'asset-thumbnail/font', lambda: generator.generate(fixture.fonts[0])
+    yield 'asset-thumbnail/image', lambda: generator.generate(fixture.images[0])
+
+    def rasterize(tate, outline):
+        with AssetFactory(fixture.url) as assets:
+            face = assets.get('font', fixture.fonts[0])
+            for char in (TATE_TEXT if tate else YOKO_TEXT):
+                GlyphWriter(Character(char=char, x=0, y=0, width=48, height=48, rotation=0.0, face=face, color=(0, 0, 0, 255),
+                                      outline_color=(255, 255, 255, 255) if outline else None, outline_width=2 if outline else 0,
+                                      tate=tate))._rasterize()
+    yield 'rasterize/yoko', lambda: rasterize(False, False)
+    yield 'rasterize/tate', lambda: rasterize(True, False)
+    yield 'rasterize/outlined', lambda: rasterize(False, True)
+
+    def extract():
+        with AssetFactory(fixture.url) as assets:
+            for key in fixture.fonts:
+                assets.get('font', key)
+            for key in fixture.images:
+                assets.get('image', key)
+    yield 'extract', extract
+
+def run(fonts, repeat=5, only=None):
+    path = tempfile.mkdtemp(prefix='belle-bench-')
+    try:
+        fixture = Fixture(path, fonts)
+        results = dict()
+        for name, func in benchmarks(fixture):
+            if only is not None and not name.startswith(only):
+                continue
+            log.info('running %s' % name)
+            results[name] = measure(func, repeat)
+        return dict(meta=dict(python=platform.python_version(), platform=platform.platform(), fonts=[os.path.basename(f) for f in fonts], repeat=repeat, time=time.time()),
+                    results=results)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+def compare(results, baseline, threshold=0.1):
+    regressions = []
+    for name in sorted(results['results']):
+        current = results['results'][name]['median']
+        base = baseline['results'].get(name, {}).get('median')
+        if base is None:
+            print >>sys.stderr, '%-28s %9.4fs  (new)' % (name, current)
+            continue
+        ratio = current / base if base else float('inf')
+        mark = ''
+        if ratio > 1.0 + threshold:
+            mark = '  REGRESSION'
+            regressions.append(name)
+        print >>sys.stderr, '%-28s %9.4fs  %9.4fs  %+6.1f%%%s' % (name, current, base, (ratio - 1.0) * 100, mark)
+    return regressions
+
+if __name__ == '__main__':
+    import optparse
+
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--font', dest='fonts', action='append', default=[], help='font file to bundle into the fixture store (repeatable; default: first fonts found on the system)')
+    parser.add_option('--repeat', dest='repeat', type='int', default=5, help='number of timed runs per benchmark')
+    parser.add_option('--only', dest='only', default=None, help='run only benchmarks whose name starts with this prefix')
+    parser.add_option('--output', dest='output', default=None, help='file to write the JSON results to (default: stdout)')
+    parser.add_option('--baseline', dest='baseline', default=None, help='JSON results to compare against; exits 1 on regression')
+    parser.add_option('--threshold', dest='threshold', type='float', default=0.1, help='relative slowdown of the median reported as a regression')
+    options, args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+    fonts = options.fonts or find_fonts()
+    if not fonts:
+        parser.error('no fonts found; pass one with --font')
+
+    results = run(fonts, options.repeat, options.only)
+    if options.output is not None:
+        with open(options.output, 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+    if options.baseline is not None:
+        with open(options.baseline, 'rb') as f:
+            baseline = json.load(f)
+        sys.exit(1 if compare(results, baseline, options.threshold) else 0)
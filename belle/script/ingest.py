@@ -0,0 +1,230 @@
+import hashlib
+import logging
+import mimetypes
+import os
+import sqlite3
+import sys
+import time
+import unicodedata
+
+log = logging.getLogger(__name__)
+
+CHUNK = 1024 * 1024
+BATCH = 200
+BATCH_BYTES = 64 * 1024 * 1024
+FONT_EXTENSIONS = ('.otf', '.ttf', '.ttc', '.fon')
+
+SCHEMA = [
+    'create table if not exists asset (name varchar, hash varchar, type varchar, blob blob, path varchar)',
+    'create table if not exists ingested (path varchar primary key, size integer, mtime real, hash varchar)',
+]
+
+def _guess_type(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in FONT_EXTENSIONS:
+        return 'font'
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+def _hash(path):
+    try:
+        st = os.stat(path)
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK), ''):
+                digest.update(chunk)
+        return path, st.st_size, st.st_mtime, digest.hexdigest(), None
+    except (IOError, OSError), e:
+        return path, None, None, None, str(e)
+
+class ChangedError(Exception):
+    pass
+
+def _read(path, hash):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), ''):
+            digest.update(chunk)
+            yield chunk
+    if digest.hexdigest() != hash:
+        raise ChangedError(path)
+
+def _walk(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    yield os.path.abspath(os.path.join(dirpath, filename))
+        else:
+            yield os.path.abspath(path)
+
+def connect(db):
+    conn = sqlite3.connect(db)
+    conn.text_factory = str
+    conn.execute('pragma journal_mode=wal')
+    conn.execute('pragma synchronous=normal')
+    for statement in SCHEMA:
+        conn.execute(statement)
+    try:
+        conn.execute('create unique index if not exists asset_hash on asset (hash)')
+    except sqlite3.IntegrityError:
+        log.warn('asset table has duplicate hashes; creating a non-unique index')
+        conn.execute('create index if not exists asset_hash on asset (hash)')
+    conn.commit()
+    return conn
+
+class SQLiteStore(object):
+    def __init__(self, db):
+        self.conn = connect(db)
+
+    def done(self):
+        return dict(((path, (size, mtime)) for path, size, mtime in self.conn.execute('select path, size, mtime from ingested')))
+
+    def known(self):
+        return set(hash for hash, in self.conn.execute('select hash from asset'))
+
+    def add(self, name, hash, type, path):
+        # Python 2's sqlite3 has no incremental blob I/O, so the row is bound whole; it goes out before the next file is read.
+        blob = bytearray()
+        for chunk in _read(path, hash):
+            blob.extend(chunk)
+        self.conn.execute('insert or ignore into asset (name, hash, type, blob) values (?, ?, ?, ?)', (name, hash, type, buffer(blob)))
+        return len(blob)
+
+    def flush(self, records):
+        with self.conn:
+            self.conn.executemany('insert or replace into ingested (path, size, mtime, hash) values (?, ?, ?, ?)', records)
+
+    def close(self):
+        self.conn.close()
+
+class PackStore(object):
+    def __init__(self, path):
+        from belle.pack import PackWriter
+        self.writer = PackWriter(path)
+        self.log = path + '.ingested'
+
+    def done(self):
+        done = dict()
+        if os.path.exists(self.log):
+            with open(self.log, 'rb') as f:
+                for line in f:
+                    try:
+                        path, size, mtime, hash = line.rstrip('\n').split('\t')
+                        done[path.decode('string_escape')] = (int(size), float(mtime))
+                    except ValueError:
+                        # A line cut short by an interrupted run.
+                        continue
+        return done
+
+    def known(self):
+        return set(digest.encode('hex') for digest in self.writer.entries)
+
+    def add(self, name, hash, type, path):
+        length = self.writer.end
+        self.writer.append_stream(hash, type, _read(path, hash))
+        return self.writer.end - length
+
+    def flush(self, records):
+        self.writer.commit()
+        # Recorded only once the index is committed, so a resumed run never skips a file the pack lacks.
+        with open(self.log, 'ab') as f:
+            for path, size, mtime, hash in records:
+                f.write('%s\t%d\t%r\t%s\n' % (path.encode('string_escape'), size, mtime, hash))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        self.writer.close()
+
+def ingest(target, paths, workers=None, batch=BATCH):
+    import multiprocessing
+
+    if target.startswith('pack:'):
+        store = PackStore(target[5:])
+    else:
+        store = SQLiteStore(target)
+    try:
+        done = store.done()
+        known = store.known()
+
+        pending = []
+        skipped = 0
+        for path in _walk(paths):
+            try:
+                st = os.stat(path)
+            except OSError, e:
+                log.warn('cannot stat %s: %s' % (path, e))
+                continue
+            if done.get(path) == (st.st_size, st.st_mtime):
+                skipped += 1
+            else:
+                pending.append(path)
+        log.info('%d files to ingest, %d already ingested' % (len(pending), skipped))
+
+        pool = multiprocessing.Pool(workers)
+        stats = dict(inserted=0, duplicates=0, failed=0, bytes=0)
+        started = time.time()
+        try:
+            records, size = [], 0
+            for path, st_size, mtime, hash, error in pool.imap(_hash, pending, chunksize=16):
+                if error is not None:
+                    log.warn('cannot read %s: %s' % (path, error))
+                    stats['failed'] += 1
+                    continue
+                if hash in known:
+                    stats['duplicates'] += 1
+                else:
+                    name = unicodedata.normalize('NFC', os.path.basename(path).decode(sys.getfilesystemencoding() or 'UTF-8', 'replace')).encode('UTF-8')
+                    try:
+                        length = store.add(name, hash, _guess_type(path), path)
+                    except ChangedError:
+                        log.warn('%s changed while ingesting, skipping' % path)
+                        stats['failed'] += 1
+                        continue
+                    except (IOError, OSError), e:
+                        log.warn('cannot read %s: %s' % (path, e))
+                        stats['failed'] += 1
+                        continue
+                    known.add(hash)
+                    size += length
+                    stats['inserted'] += 1
+                    stats['bytes'] += length
+                records.append((path, st_size, mtime, hash))
+                if len(records) >= batch or size >= BATCH_BYTES:
+                    _flush(store, records)
+                    records, size = [], 0
+            _flush(store, records)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        log.info('inserted %(inserted)d assets (%(bytes)d bytes), %(duplicates)d duplicates, %(failed)d failed' % stats
+                 + ' in %.3fs' % (time.time() - started))
+        return stats
+    finally:
+        store.close()
+
+def _flush(store, records):
+    if not records:
+        return
+    store.flush(records)
+    log.debug('committed %d files' % len(records))
+
+if __name__ == '__main__':
+    import optparse
+
+    parser = optparse.OptionParser(usage='%prog [options] <assets.db|pack:path> <file-or-directory>...')
+    parser.add_option('--workers', dest='workers', type='int', default=None, help='number of hashing processes (default: number of CPUs)')
+    parser.add_option('--batch', dest='batch', type='int', default=BATCH, help='number of files per transaction')
+    options, args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+    if len(args) < 2:
+        parser.print_usage()
+        sys.exit(127)
+    stats = ingest(args[0], args[1:], workers=options.workers, batch=options.batch)
+    sys.exit(1 if stats['failed'] else 0)
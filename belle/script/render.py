@@ -1,19 +1,40 @@
+import contextlib
 import logging
-import Image, ImageDraw
+import sys
+import time
+import Image
+
+from belle import stats
 
 log = logging.getLogger(__name__)
 
-def _render(asset_url, paper_width=None, paper_height=None):
-    import sys
+def _parse(source=None):
     import xml.etree.ElementTree as ET
 
-    from belle.asset import AssetFactory, AssetNotFoundError
-    from belle.glyph import Character, GlyphWriter, NormalMapping
-    from belle.tools import HTMLColorParser, PixelCoords
-    from belle.image import Img, ImgWriter
+    if source is None:
+        source = sys.stdin
+    with stats.timer('render.parse'):
+        return ET.parse(source).getroot()
 
-    root = ET.XML(sys.stdin.read())
+def _render(asset_url, paper_width=None, paper_height=None, root=None, assets=None, workers=None, draft=False, renderer=None, missing=None):
+    with _open_assets(asset_url, assets) as assets:
+        page = _load(root, assets, paper_width, paper_height, draft=draft, missing=missing)
+        with stats.timer('render.composite'):
+            if renderer is not None:
+                return renderer.render(page, workers=workers)
+            return page.render(workers=workers)
 
+@contextlib.contextmanager
+def _open_assets(asset_url, assets=None):
+    from belle.asset import AssetFactory
+
+    if assets is not None:
+        yield assets
+    else:
+        with AssetFactory(asset_url) as assets:
+            yield assets
+
+def _paper_size(root, paper_width=None, paper_height=None):
     try:
         native_width = int(root.attrib['width'])
         native_height = int(root.attrib['height'])
@@ -32,58 +53,237 @@ def _render(asset_url, paper_width=None, paper_height=None):
         else:
             paper_width = native_width * (paper_height / float(native_height))
 
-    paper_width = int(paper_width)
-    paper_height = int(paper_height)
+    return int(paper_width), int(paper_height)
+
+def _load(root, assets, paper_width=None, paper_height=None, draft=False, missing=None):
+    from belle.page import Page
+
+    if root is None:
+        root = _parse()
 
-    im = Image.new('RGBA', (paper_width, paper_height), (255,255,255,255))
-    draw = ImageDraw.Draw(im)
+    paper_width, paper_height = _paper_size(root, paper_width, paper_height)
+    page = Page(paper_width, paper_height)
+    with stats.timer('render.prefetch'):
+        assets.prefetch(_asset_keys(root))
+    with stats.timer('render.load'):
+        for layer in root.findall('layer'):
+            page.layers.append(_load_layer(layer, assets, paper_width, paper_height, draft, missing))
+    return page
 
+def _asset_keys(root):
+    keys = []
     for layer in root.findall('layer'):
-        with AssetFactory(asset_url) as assets:
-            try:
-                for img_ in layer.findall('image'):
-                    img = Img(src=assets.get('image', img_.attrib['src']),
-                              x=PixelCoords(paper_width, paper_height).u(float(img_.attrib.get('x', 0))),
-                              y=PixelCoords(paper_width, paper_height).v(float(img_.attrib.get('y', 0))),
-                              width=PixelCoords(paper_width, paper_height).u(float(img_.attrib.get('width', 0))),
-                              height=PixelCoords(paper_width, paper_height).v(float(img_.attrib.get('height', 0))),
-                              rotation=float(img_.attrib.get('rotate', 0)))
-                    ImgWriter(img).write(im)
-                
-                for char_ in layer.findall('char'):
-                    text = char_.text
-                    if text is not None:
-                        if not isinstance(text, unicode) and isinstance(text, str):
-                            text = text.decode('UTF-8', 'replace')
-                        char = Character(char=text,
-                                         x=PixelCoords(paper_width, paper_height).u(float(char_.attrib.get('x', 0))),
-                                         y=PixelCoords(paper_width, paper_height).v(float(char_.attrib.get('y', 0))),
-                                         width=PixelCoords(paper_width, paper_height).u(float(char_.attrib.get('width', 0))),
-                                         height=PixelCoords(paper_width, paper_height).v(float(char_.attrib.get('height', 0))),
-                                         rotation=float(char_.attrib.get('rotate', 0)),
-                                         face=assets.get('font', char_.attrib.get('face', u'')),
-                                         color=HTMLColorParser(char_.attrib.get('color')).rgba(),
-                                         outline_color=HTMLColorParser(char_.attrib.get('outline-color')).rgba(),
-                                         outline_width=PixelCoords(paper_width, paper_height, minimum=1).u(float(char_.attrib.get('outline-edge', 0.0))),
-                                         tate=(char_.attrib.get('tate') is not None),
-                                         pivot=char_.attrib.get('pivot'),
-                                         index=char_.attrib.get('index', 0))
-                        GlyphWriter(char).write(im)
-            except AssetNotFoundError, e:
-                log.warn(str(e))
+        keys.extend(img_.attrib['src'] for img_ in layer.findall('image') if 'src' in img_.attrib)
+        keys.extend(char_.attrib.get('face', u'') for char_ in layer.findall('char') if char_.text is not None)
+        keys.extend(text_.attrib.get('face', u'') for text_ in layer.findall('text') if text_.text is not None)
+    return keys
+
+def _load_layer(layer, assets, paper_width, paper_height, draft=False, missing=None):
+    from belle.asset import AssetNotFoundError
+
+    elements = []
+    try:
+        for img_ in layer.findall('image'):
+            element = _load_image(img_, assets, paper_width, paper_height, draft)
+            if element is not None:
+                elements.append(element)
+
+        for char_ in layer.findall('char'):
+            element = _load_char(char_, assets, paper_width, paper_height)
+            if element is not None:
+                elements.append(element)
+
+        for text_ in layer.findall('text'):
+            elements.extend(_load_text(text_, assets, paper_width, paper_height))
+    except AssetNotFoundError, e:
+        log.warn(str(e))
+        if missing is not None:
+            missing.append(e.key)
+    return elements
+
+def _load_image(img_, assets, paper_width, paper_height, draft=False):
+    from belle.tools import PixelCoords
+    from belle.image import Img, ImgWriter
+
+    img = Img(src=assets.get('image', img_.attrib['src']),
+              x=PixelCoords(paper_width, paper_height).u(float(img_.attrib.get('x', 0))),
+              y=PixelCoords(paper_width, paper_height).v(float(img_.attrib.get('y', 0))),
+              width=PixelCoords(paper_width, paper_height).u(float(img_.attrib.get('width', 0))),
+              height=PixelCoords(paper_width, paper_height).v(float(img_.attrib.get('height', 0))),
+              rotation=float(img_.attrib.get('rotate', 0)),
+              draft=draft)
+    if img.width < 1 or img.height < 1:
+        return None
+    return ImgWriter(img)
+
+def _load_char(char_, assets, paper_width, paper_height):
+    from belle.glyph import Character, GlyphWriter
+    from belle.tools import HTMLColorParser, PixelCoords
+
+    text = char_.text
+    if text is None:
+        return None
+    if not isinstance(text, unicode) and isinstance(text, str):
+        text = text.decode('UTF-8', 'replace')
+    char = Character(char=text,
+                     x=PixelCoords(paper_width, paper_height).u(float(char_.attrib.get('x', 0))),
+                     y=PixelCoords(paper_width, paper_height).v(float(char_.attrib.get('y', 0))),
+                     width=PixelCoords(paper_width, paper_height).u(float(char_.attrib.get('width', 0))),
+                     height=PixelCoords(paper_width, paper_height).v(float(char_.attrib.get('height', 0))),
+                     rotation=float(char_.attrib.get('rotate', 0)),
+                     face=assets.get('font', char_.attrib.get('face', u'')),
+                     color=HTMLColorParser(char_.attrib.get('color')).rgba(),
+                     outline_color=HTMLColorParser(char_.attrib.get('outline-color')).rgba(),
+                     outline_width=PixelCoords(paper_width, paper_height, minimum=1).u(float(char_.attrib.get('outline-edge', 0.0))),
+                     tate=(char_.attrib.get('tate') is not None),
+                     pivot=char_.attrib.get('pivot'),
+                     index=char_.attrib.get('index', 0))
+    if char.height < 1:
+        return None
+    return GlyphWriter(char)
+
+def _load_text(text_, assets, paper_width, paper_height):
+    from belle.glyph import GlyphWriter, TextRun
+    from belle.tools import HTMLColorParser, PixelCoords
+
+    text = text_.text
+    if text is None:
+        return []
+    if not isinstance(text, unicode) and isinstance(text, str):
+        text = text.decode('UTF-8', 'replace')
+    run = TextRun(text=text,
+                  x=PixelCoords(paper_width, paper_height).u(float(text_.attrib.get('x', 0))),
+                  y=PixelCoords(paper_width, paper_height).v(float(text_.attrib.get('y', 0))),
+                  height=PixelCoords(paper_width, paper_height).v(float(text_.attrib.get('height', 0))),
+                  face=assets.get('font', text_.attrib.get('face', u'')),
+                  color=HTMLColorParser(text_.attrib.get('color')).rgba(),
+                  outline_color=HTMLColorParser(text_.attrib.get('outline-color')).rgba(),
+                  outline_width=PixelCoords(paper_width, paper_height, minimum=1).u(float(text_.attrib.get('outline-edge', 0.0))),
+                  tate=(text_.attrib.get('tate') is not None),
+                  index=text_.attrib.get('index', 0))
+    if run.height < 1:
+        return []
+    return [GlyphWriter(char) for char in run.characters()]
+
+def _render_stream(asset_url, source=None, paper_width=None, paper_height=None, assets=None, draft=False):
+    import xml.etree.ElementTree as ET
+    from belle.asset import AssetNotFoundError
+    from belle.page import Page
+
+    if source is None:
+        source = sys.stdin
+
+    loaders = dict(image=lambda elem: [_load_image(elem, assets, paper_width, paper_height, draft)],
+                   char=lambda elem: [_load_char(elem, assets, paper_width, paper_height)],
+                   text=lambda elem: _load_text(elem, assets, paper_width, paper_height))
+    im = None
+    root = layer = None
+    path = []
+    skip = False
+    seen_char = False
+    with _open_assets(asset_url, assets) as assets:
+        for event, elem in ET.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                path.append(elem.tag)
+                if im is None:
+                    root = elem
+                    paper_width, paper_height = _paper_size(elem, paper_width, paper_height)
+                    im = Image.new('RGBA', (paper_width, paper_height), Page.BACKGROUND)
+                elif path[1:] == ['layer']:
+                    layer = elem
+                    skip = seen_char = False
+                continue
+
+            if len(path) == 3 and path[1] == 'layer':
+                if elem.tag in loaders and not skip:
+                    if elem.tag == 'image' and seen_char:
+                        log.warn('image after chars in a layer; compositing in document order')
+                    seen_char = seen_char or elem.tag != 'image'
+                    try:
+                        for element in loaders[elem.tag](elem):
+                            if element is not None:
+                                element.write(im)
+                    except AssetNotFoundError, e:
+                        log.warn(str(e))
+                        skip = True
+                # Detach each finished element so parse memory stays flat however long the layer is.
+                layer.remove(elem)
+            elif len(path) == 2:
+                root.remove(elem)
+            path.pop()
     return im
 
-def render(asset_url, paper_width=None, paper_height=None):
-    im = _render(asset_url=asset_url, paper_width=paper_width, paper_height=paper_height)
-    return im.save(sys.stdout, format="PNG")
-    
-def render_thumbnail(asset_url, paper_width=None, paper_height=None):
-    INTERMEDIATE_SIZE = (800, 800)
-    
-    im = _render(asset_url=asset_url, paper_width=INTERMEDIATE_SIZE[0], paper_height=INTERMEDIATE_SIZE[1])
-    if (paper_width, paper_height) != INTERMEDIATE_SIZE:
-        im.thumbnail((paper_width, paper_height), Image.ANTIALIAS)
-    return im.save(sys.stdout, format="PNG")
+def _save(im, to, encoder=None):
+    from belle.encoder import Encoder
+
+    with stats.timer('render.encode'):
+        (encoder or Encoder()).encode(im, to)
+
+def _render_encoded(asset_url, root, encoder=None, paper_width=None, paper_height=None, assets=None, workers=None, thumbnail=False, renderer=None):
+    import cStringIO
+    from belle.encoder import Encoder
+    from belle.page import pages
+
+    if encoder is None:
+        encoder = Encoder()
+
+    key = None
+    if pages.store is not None and renderer is None:
+        key = pages.key(asset_url, root, (paper_width, paper_height, thumbnail), encoder.key())
+        data = pages.get(key)
+        if data is not None:
+            stats.count('page.cache.hit')
+            log.debug('page cache hit %s' % key)
+            return data
+        stats.count('page.cache.miss')
+
+    missing = []
+    if thumbnail:
+        im = _render_thumbnail(asset_url, paper_width, paper_height, root=root, assets=assets, missing=missing)
+    else:
+        im = _render(asset_url, paper_width, paper_height, root=root, assets=assets, workers=workers, renderer=renderer, missing=missing)
+    out = cStringIO.StringIO()
+    _save(im, out, encoder)
+    data = out.getvalue()
+    if key is not None:
+        if missing:
+            # The assets may turn up later; don't keep serving a page rendered without them.
+            log.debug('not caching page %s: %d missing assets' % (key, len(missing)))
+        else:
+            pages.put(key, data)
+    return data
+
+def render(asset_url, paper_width=None, paper_height=None, strip_height=None, workers=None, stream=False, encoder=None):
+    from belle.page import pages
+
+    if stream:
+        return _save(_render_stream(asset_url, paper_width=paper_width, paper_height=paper_height), sys.stdout, encoder)
+    if strip_height is not None:
+        return _render_strips(asset_url, sys.stdout, paper_width, paper_height, strip_height, workers=workers, encoder=encoder)
+    if pages.store is None:
+        return _save(_render(asset_url, paper_width, paper_height, root=_parse(), workers=workers), sys.stdout, encoder)
+    return sys.stdout.write(_render_encoded(asset_url, _parse(), encoder, paper_width=paper_width, paper_height=paper_height, workers=workers))
+
+def _render_strips(asset_url, to, paper_width=None, paper_height=None, strip_height=None, root=None, assets=None, workers=None, encoder=None):
+    from belle.encoder import Encoder
+
+    with _open_assets(asset_url, assets) as assets:
+        page = _load(root, assets, paper_width, paper_height)
+        with stats.timer('render.strips'):
+            out = (encoder or Encoder()).strip_writer(to, page.width, page.height)
+            for top, strip in page.strips(strip_height or page.STRIP_HEIGHT, workers=workers):
+                out.write(strip)
+            out.close()
+
+def render_thumbnail(asset_url, paper_width=None, paper_height=None, encoder=None):
+    return sys.stdout.write(_render_encoded(asset_url, _parse(), encoder, paper_width=paper_width, paper_height=paper_height, thumbnail=True))
+
+def _render_thumbnail(asset_url, paper_width, paper_height, root=None, assets=None, missing=None):
+    OVERSAMPLE = 2
+
+    im = _render(asset_url=asset_url, paper_width=paper_width * OVERSAMPLE, paper_height=paper_height * OVERSAMPLE, root=root, assets=assets, draft=True, missing=missing)
+    im.thumbnail((paper_width, paper_height), Image.ANTIALIAS)
+    return im
 
 def generate_thumbnail(asset_url, asset_id, x, y):
     from belle.asset import AssetThumbnailGenerator
@@ -91,16 +291,183 @@ def generate_thumbnail(asset_url, asset_id, x, y):
     x, y = int(x), int(y)
     sys.stdout.write(AssetThumbnailGenerator(asset_url, x, y).generate(asset_id))
 
+def render_batch(asset_url, manifest, workers=None, encoder=None):
+    import multiprocessing
+    import os
+    from belle.encoder import Encoder
+
+    if encoder is None:
+        encoder = Encoder()
+
+    jobs = []
+    failures = 0
+    with open(manifest) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                # Check each line before anything is rendered, so a bad output format costs no render and leaves no file.
+                fields = line.split(None, 1)
+                if len(fields) != 2:
+                    failures += 1
+                    log.error('skipping manifest line %r: expected <design> <output>' % line)
+                    continue
+                design, output = fields
+                try:
+                    jobs.append((design, output, encoder.with_format(os.path.splitext(output)[1][1:] or 'PNG')))
+                except ValueError, e:
+                    failures += 1
+                    log.error('skipping %s -> %s: %s' % (design, output, e))
+    total = len(jobs) + failures
+
+    pool = multiprocessing.Pool(workers, _batch_init, (asset_url,))
+    started = time.time()
+    try:
+        for design, output, elapsed, error in pool.imap_unordered(_batch_render, jobs):
+            if error is None:
+                log.info('rendered %s -> %s in %.3fs' % (design, output, elapsed))
+            else:
+                failures += 1
+                log.error('failed to render %s -> %s in %.3fs: %s' % (design, output, elapsed, error))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    log.info('rendered %d of %d pages in %.3fs' % (total - failures, total, time.time() - started))
+    return failures
+
+_batch_assets = None
+
+def _batch_init(asset_url):
+    import multiprocessing.util
+    from belle.asset import AssetFactory
+
+    global _batch_assets
+    _batch_assets = AssetFactory(asset_url).__enter__()
+    multiprocessing.util.Finalize(_batch_assets, _batch_assets.__exit__, args=(None, None, None), exitpriority=10)
+
+def _batch_render(job):
+    import cStringIO
+
+    design, output, encoder = job
+    started = time.time()
+    try:
+        with open(design, 'rb') as f:
+            root = _parse(f)
+        im = _render(None, root=root, assets=_batch_assets)
+        out = cStringIO.StringIO()
+        _save(im, out, encoder)
+        with open(output, 'wb') as f:
+            f.write(out.getvalue())
+        return design, output, time.time() - started, None
+    except Exception, e:
+        log.debug('failed to render %s' % design, exc_info=True)
+        return design, output, time.time() - started, '%s: %s' % (e.__class__.__name__, e)
+
+def serve(asset_url, address='127.0.0.1:8080', workers=None):
+    from belle.asset import AssetFactory
+    from belle.server import RenderServer
+
+    with AssetFactory(asset_url) as assets:
+        server = RenderServer(address, asset_url, assets, workers=workers or 4)
+        log.info('serving %s on %s' % (asset_url, address))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
 if __name__ == '__main__':
-    import sys
+    import optparse
+
+    parser = optparse.OptionParser(usage='%prog render|render-thumbnail|generate-thumbnail|render-batch|serve <asset_url> [args...]')
+    parser.add_option('--glyph-cache', dest='glyph_cache', default=None, help='directory to persist rendered glyphs in')
+    parser.add_option('--glyph-cache-limit', dest='glyph_cache_limit', type='int', default=None, help='size budget of the glyph cache directory in bytes')
+    parser.add_option('--page-cache', dest='page_cache', default=None, help='directory (or sqlite:<path>) to cache rendered pages in')
+    parser.add_option('--page-cache-limit', dest='page_cache_limit', type='int', default=None, help='size budget of the page cache in bytes')
+    parser.add_option('--image-cache', dest='image_cache', default=None, help='directory to persist resized images in')
+    parser.add_option('--image-cache-limit', dest='image_cache_limit', type='int', default=None, help='size budget of the image cache directory in bytes')
+    parser.add_option('--image-cache-memory', dest='image_cache_memory', type='int', default=None, help='in-memory budget of the image cache in bytes (default: 256MB, or 0 for --strip-height and --stream renders)')
+    parser.add_option('--asset-cache', dest='asset_cache', default=None, help='directory to keep fetched assets in across runs')
+    parser.add_option('--asset-cache-limit', dest='asset_cache_limit', type='int', default=None, help='size budget of the asset cache directory in bytes')
+    parser.add_option('--strip-height', dest='strip_height', type='int', default=None, help='render in horizontal strips of this many pixels and stream them out as PNG')
+    parser.add_option('--format', dest='format', default='png', help='output format: png, jpeg or webp (render-batch uses the output file extension)')
+    parser.add_option('--compress-level', dest='compress_level', type='int', default=6, help='PNG zlib compression level (0-9)')
+    parser.add_option('--png-filter', dest='png_filter', default=None, help='PNG row filter: none, sub, up, average or paeth (default: encoder\'s adaptive choice)')
+    parser.add_option('--quality', dest='quality', type='int', default=75, help='JPEG/WebP quality (1-100)')
+    parser.add_option('--progressive', dest='progressive', action='store_true', default=False, help='write progressive JPEG')
+    parser.add_option('--stream', dest='stream', action='store_true', default=False, help='render elements as they are parsed from stdin')
+    parser.add_option('--engine', dest='engine', default='pil', help='compositing engine (pil or numpy)')
+    parser.add_option('--stats', dest='stats', action='store_true', default=False, help='dump per-stage timings and counters as JSON to stderr on exit')
+    parser.add_option('--workers', dest='workers', type='int', default=None, help='number of concurrent jobs in serve and render-batch modes, or of tile threads in render mode')
+    options, args = parser.parse_args()
+
     logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
-    
-    mode = sys.argv[1]
+
+    if options.stats:
+        import atexit
+        import json
+
+        stats.enable()
+        atexit.register(lambda: sys.stderr.write(json.dumps(stats.snapshot(), sort_keys=True) + '\n'))
+
+    if options.engine != 'pil':
+        from belle import engine
+        try:
+            engine.use(options.engine)
+        except (ImportError, ValueError), e:
+            parser.error(str(e))
+
+    if options.glyph_cache is not None:
+        from belle.glyph import glyphs
+        glyphs.persist(options.glyph_cache, options.glyph_cache_limit)
+
+    if options.page_cache is not None:
+        from belle.page import pages
+        pages.persist(options.page_cache, options.page_cache_limit)
+
+    if args[:1] in (['render'], ['render-thumbnail']):
+        # A single page never reuses its flattened static layers; render() then draws straight onto the base.
+        from belle.page import flattened
+        flattened.resize(0)
+
+    from belle.image import images
+    if options.image_cache is not None:
+        images.persist(options.image_cache, options.image_cache_limit)
+    if options.image_cache_memory is not None:
+        images.resize(options.image_cache_memory)
+    elif args[:1] == ['render'] and (options.strip_height is not None or options.stream):
+        # A one-shot bounded-memory render never sees a transformed image again once its strips are done.
+        images.resize(0)
+
+    if options.asset_cache is not None:
+        from belle.asset import cache
+        cache.persist(options.asset_cache, options.asset_cache_limit)
+
+    from belle.encoder import Encoder
+    try:
+        encoder = Encoder(options.format, options.compress_level, options.png_filter, options.quality, options.progressive)
+    except ValueError, e:
+        parser.error(str(e))
+
+    if not args:
+        sys.exit(127)
+    mode = args[0]
     if mode == 'render':
-        render(sys.argv[2])
+        if options.stream and (options.strip_height is not None or options.workers is not None):
+            parser.error('--stream cannot be combined with --strip-height or --workers')
+        if options.strip_height is not None and encoder.format != 'PNG':
+            parser.error('--strip-height only supports PNG output')
+        render(args[1], strip_height=options.strip_height, workers=options.workers, stream=options.stream, encoder=encoder)
     elif mode == 'render-thumbnail':
-        render_thumbnail(sys.argv[2], paper_width=int(sys.argv[3]), paper_height=int(sys.argv[4]))
+        render_thumbnail(args[1], paper_width=int(args[2]), paper_height=int(args[3]), encoder=encoder)
     elif mode == 'generate-thumbnail':
-        generate_thumbnail(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5])
+        generate_thumbnail(args[1], args[2], args[3], args[4])
+    elif mode == 'render-batch':
+        sys.exit(1 if render_batch(args[1], args[2], workers=options.workers, encoder=encoder) else 0)
+    elif mode == 'serve':
+        serve(args[1], *args[2:3], workers=options.workers)
     else:
         sys.exit(127)
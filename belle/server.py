@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import BaseHTTPServer
+import SocketServer
+import cStringIO
+import json
+import logging
+import os
+import threading
+import urlparse
+
+from belle import stats
+from belle.cache import LRUCache
+
+log = logging.getLogger(__name__)
+
+class BoundedThreadingMixIn(SocketServer.ThreadingMixIn):
+    daemon_threads = True
+    workers = 4
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        try:
+            t = threading.Thread(target=self._process_request_slot, args=(request, client_address))
+            t.daemon = self.daemon_threads
+            t.start()
+        except:
+            self.slots.release()
+            raise
+
+    def _process_request_slot(self, request, client_address):
+        try:
+            self.process_request_thread(request, client_address)
+        finally:
+            self.slots.release()
+
+class RenderRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        from belle.encoder import Encoder
+        from belle.script.render import _parse, _render_encoded
+
+        params = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        try:
+            encoder = Encoder(params.get('format', ['png'])[0],
+                              compress_level=self._int_param(params, 'compress-level', 6),
+                              filter=params.get('filter', [None])[0],
+                              quality=self._int_param(params, 'quality', 75),
+                              progressive=params.get('progressive', ['0'])[0] not in ('0', 'false', ''))
+        except ValueError, e:
+            return self.send_error(400, str(e))
+
+        try:
+            width = self._int_param(params, 'width')
+            height = self._int_param(params, 'height')
+            length = int(self.headers.getheader('content-length'))
+        except (TypeError, ValueError):
+            return self.send_error(400, 'bad request')
+
+        try:
+            root = _parse(cStringIO.StringIO(self.rfile.read(length)))
+        except SyntaxError, e:
+            return self.send_error(400, 'malformed design: %s' % e)
+
+        try:
+            session = params.get('session', [None])[0]
+            if session is None:
+                body = _render_encoded(self.server.asset_url, root, encoder, width, height, assets=self.server.assets)
+            else:
+                renderer = self.server.session(session)
+                with renderer.lock:
+                    body = _render_encoded(self.server.asset_url, root, encoder, width, height, assets=self.server.assets, renderer=renderer)
+        except Exception, e:
+            log.exception('render failed')
+            return self.send_error(500, str(e))
+
+        self._send(200, encoder.content_type, body)
+
+    def do_GET(self):
+        from belle.page import pages
+
+        if urlparse.urlparse(self.path).path != '/stats':
+            return self.send_error(404)
+        body = dict(page_cache=pages.stats())
+        if stats.enabled:
+            body['stages'] = stats.snapshot()
+        self._send(200, 'application/json', json.dumps(body))
+
+    def _send(self, status, type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _int_param(self, params, name, default=None):
+        try:
+            return int(params[name][0])
+        except KeyError:
+            return default
+
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return BaseHTTPServer.BaseHTTPRequestHandler.address_string(self)
+        return 'local'
+
+    def log_message(self, format, *args):
+        log.info('%s %s' % (self.address_string(), format % args))
+
+class _RenderServerMixIn(BoundedThreadingMixIn):
+    SESSIONS = 16
+
+    def setup_renderer(self, asset_url, assets, workers):
+        self.asset_url = asset_url
+        self.assets = assets
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(workers)
+        self.sessions = LRUCache(self.SESSIONS)
+
+    def session(self, id):
+        from belle.page import IncrementalRenderer
+
+        with self.sessions.lock:
+            renderer = self.sessions.get(id)
+            if renderer is None:
+                renderer = self.sessions[id] = IncrementalRenderer()
+            return renderer
+
+class TCPRenderServer(_RenderServerMixIn, BaseHTTPServer.HTTPServer):
+    pass
+
+class UnixRenderServer(_RenderServerMixIn, SocketServer.UnixStreamServer):
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+class RenderServer(object):
+    def __new__(cls, address, asset_url, assets, workers=BoundedThreadingMixIn.workers):
+        if address.startswith('unix:'):
+            server = UnixRenderServer(address[5:], RenderRequestHandler)
+        else:
+            host, _, port = address.rpartition(':')
+            server = TCPRenderServer((host or '127.0.0.1', int(port)), RenderRequestHandler)
+        server.setup_renderer(asset_url, assets, workers)
+        return server
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+enabled = False
+
+_lock = threading.Lock()
+_timers = dict()
+_counters = dict()
+
+class _Timer(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.time() - self.started
+        with _lock:
+            calls, seconds = _timers.get(self.name, (0, 0.0))
+            _timers[self.name] = (calls + 1, seconds + elapsed)
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_null = _NullTimer()
+
+def timer(name):
+    if not enabled:
+        return _null
+    return _Timer(name)
+
+def count(name, n=1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+def snapshot():
+    with _lock:
+        return dict(timers=dict((name, dict(calls=calls, seconds=seconds)) for name, (calls, seconds) in _timers.iteritems()),
+                    counters=dict(_counters))
@@ -9,9 +9,9 @@ class FileTypeGuesser(object):
         self.filename = filename
 
     def guess(self):
-        if re.search('(otf|ttf|ttc|fon)$', filename):
+        if re.search('(otf|ttf|ttc|fon)$', self.filename):
             return 'font'
-        if re.search('(bmp|png|gif|jpg)$', filename):
+        if re.search('(bmp|png|gif|jpg)$', self.filename):
             return 'image'
         return 'unknown'
 
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+import unittest
+
+from belle.asset import AssetFactory, AssetNotFoundError
+
+class AssetServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), AssetHandler)
+        self.lock = threading.Lock()
+        self.failures = dict()
+        self.requests = dict()
+        self.delay = 0
+        self.active = 0
+        self.peak = 0
+
+class AssetHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        key = self.path.rsplit('/', 1)[-1]
+        server = self.server
+        with server.lock:
+            server.requests[key] = server.requests.get(key, 0) + 1
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+            failures = server.failures.get(key, 0)
+            if failures:
+                server.failures[key] = failures - 1
+        try:
+            time.sleep(server.delay)
+            if key.startswith('missing'):
+                self._respond(404, 'not found')
+            elif failures:
+                self._respond(503, 'unavailable')
+            else:
+                self._respond(200, 'asset %s' % key)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def _respond(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class RestAssetFactoryTest(unittest.TestCase):
+    RETRIES = 2
+    CONCURRENCY = 3
+
+    def setUp(self):
+        self.server = AssetServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        url = 'rest:http://127.0.0.1:%d/assets#retries=%d&backoff=0.001&concurrency=%d' % (self.server.server_address[1], self.RETRIES, self.CONCURRENCY)
+        self.assets = AssetFactory(url).__enter__()
+
+    def tearDown(self):
+        self.assets.__exit__(None, None, None)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def read(self, asset):
+        with open(asset.filename, 'rb') as f:
+            return f.read()
+
+    def test_get(self):
+        asset = self.assets.get('image', 'a')
+        self.assertEqual(self.read(asset), 'asset a')
+        self.assertEqual(asset.type, 'application/octet-stream')
+        self.assertTrue(self.assets.get('image', 'a') is asset)
+        self.assertEqual(self.server.requests['a'], 1)
+
+    def test_transient_failure(self):
+        self.server.failures['flaky'] = 1
+        self.assertEqual(self.read(self.assets.get('image', 'flaky')), 'asset flaky')
+        self.assertEqual(self.server.requests['flaky'], 2)
+
+    def test_retry_limit(self):
+        self.server.failures['down'] = 100
+        self.assertRaises(Exception, self.assets.get, 'image', 'down')
+        self.assertEqual(self.server.requests['down'], self.RETRIES + 1)
+
+    def test_not_found(self):
+        self.assertRaises(AssetNotFoundError, self.assets.get, 'image', 'missing')
+        self.assertEqual(self.server.requests['missing'], 1)
+
+    def test_prefetch_concurrency(self):
+        self.server.delay = 0.05
+        keys = ['k%d' % i for i in xrange(12)] + ['missing']
+        self.assets.prefetch(keys)
+        self.assertEqual(self.server.peak, self.CONCURRENCY)
+        for key in keys[:-1]:
+            self.assertEqual(self.server.requests[key], 1)
+            self.assertEqual(self.read(self.assets.get('image', key)), 'asset %s' % key)
+        self.assertEqual(sum(self.server.requests.itervalues()), len(keys))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from belle.cache import LRUCache
+
+class LRUCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(3)
+        for k in 'abc':
+            cache[k] = k
+        cache['a']
+        cache['d'] = 'd'
+        self.assertEqual(sorted(cache.content), ['a', 'c', 'd'])
+
+    def test_limit_is_enforced(self):
+        cache = LRUCache(10, sizeof=len)
+        cache['a'] = 'x' * 6
+        cache['b'] = 'x' * 6
+        self.assertEqual(list(cache.content), ['b'])
+        self.assertEqual(cache.size, 6)
+
+    def test_oversized_values_are_not_kept(self):
+        cache = LRUCache(10, sizeof=len)
+        cache['a'] = 'x' * 4
+        self.assertFalse(cache.fits('x' * 11))
+        cache['b'] = 'x' * 11
+        self.assertTrue('b' not in cache)
+        self.assertEqual(cache['a'], 'x' * 4)
+        cache['a'] = 'x' * 11
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_resize(self):
+        cache = LRUCache(10, sizeof=len)
+        cache['a'] = 'x' * 4
+        cache['b'] = 'x' * 4
+        cache.resize(0)
+        self.assertEqual(len(cache), 0)
+        cache['c'] = 'x'
+        self.assertEqual(len(cache), 0)
+
+if __name__ == '__main__':
+    unittest.main()
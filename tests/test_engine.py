@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import random
+import unittest
+import Image
+
+from belle import engine
+
+class EngineTest(unittest.TestCase):
+    SIZE = (64, 48)
+    OFFSETS = [(0, 0), (10, 7), (-5, -9), (-40, 3), (50, 40), (60, -20), (200, 200)]
+
+    def setUp(self):
+        try:
+            self.numpy = engine.NumPyEngine()
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        self.pil = engine.PILEngine()
+        self.random = random.Random(0)
+
+    def _image(self, mode, size, alpha=None):
+        data = bytearray(self.random.randrange(256) for i in xrange(size[0] * size[1] * len(mode)))
+        if alpha is not None:
+            data[3::4] = bytearray([alpha]) * (size[0] * size[1])
+        return Image.fromstring(mode, size, str(data))
+
+    def assertSameImage(self, a, b):
+        self.assertEqual(a.mode, b.mode)
+        self.assertEqual(a.size, b.size)
+        self.assertTrue(a.tostring() == b.tostring(), 'images differ')
+
+    def test_colorize(self):
+        for offset in self.OFFSETS:
+            layers = [(self._image('L', (24, 16)), offset, (255, 0, 0, 255)),
+                      (self._image('L', (24, 16)), (offset[0] + 3, offset[1] - 2), (10, 200, 30, 128))]
+            self.assertSameImage(self.pil.colorize(self.SIZE, layers), self.numpy.colorize(self.SIZE, layers))
+
+    def test_colorize_empty(self):
+        for mask in (Image.new('L', (0, 0)), Image.new('L', (5, 0)), Image.new('L', (0, 5))):
+            for offset in self.OFFSETS:
+                layers = [(mask, offset, (255, 0, 0, 255)), (self._image('L', (24, 16)), offset, (10, 200, 30, 128))]
+                self.assertSameImage(self.pil.colorize(self.SIZE, layers), self.numpy.colorize(self.SIZE, layers))
+
+    def _blend(self, sprites, origin=(0, 0)):
+        base = self._image('RGBA', self.SIZE, alpha=255)
+        self.assertSameImage(self.pil.blend(base.copy(), sprites, origin), self.numpy.blend(base.copy(), sprites, origin))
+
+    def test_blend_opaque(self):
+        for offset in self.OFFSETS:
+            self._blend([((self._image('RGBA', (20, 30), alpha=255), offset), True)])
+
+    def test_blend_alpha(self):
+        for offset in self.OFFSETS:
+            self._blend([((self._image('RGBA', (20, 30)), offset), False),
+                         ((self._image('RGBA', (30, 10), alpha=0), offset), False),
+                         ((self._image('RGBA', (30, 10), alpha=128), offset), False)])
+
+    def test_blend_empty(self):
+        for size in ((0, 0), (5, 0)):
+            for offset in self.OFFSETS:
+                self._blend([((Image.new('RGBA', size), offset), False), ((Image.new('RGBA', size), offset), True),
+                             ((self._image('RGBA', (20, 30)), offset), False)])
+
+    def test_blend_origin(self):
+        sprites = [((self._image('RGBA', (20, 30), alpha=255), (100, 90)), True), ((self._image('RGBA', (40, 40)), (90, 70)), False)]
+        self._blend(sprites, origin=(80, 60))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import unicodedata
+import unittest
+
+from belle.glyph import GlyphLayout, GlyphPolicyTable, TategakiGlyphPolicy, YokogakiGlyphPolicy
+
+RANGES = [
+    (0x0020, 0x007f),  # ASCII
+    (0x00a0, 0x0100),  # Latin-1 Supplement
+    (0x2000, 0x2070),  # General Punctuation
+    (0x2190, 0x2200),  # Arrows
+    (0x2500, 0x2580),  # Box Drawing
+    (0x3000, 0x3040),  # CJK Symbols and Punctuation
+    (0x3040, 0x30a0),  # Hiragana
+    (0x30a0, 0x3100),  # Katakana
+    (0x4e00, 0x5000),  # CJK Unified Ideographs (sample)
+    (0xfe30, 0xfe50),  # CJK Compatibility Forms
+    (0xff00, 0xfff0),  # Halfwidth and Fullwidth Forms
+]
+
+def _chars():
+    for start, end in RANGES:
+        for codepoint in xrange(start, end):
+            char = unichr(codepoint)
+            if unicodedata.name(char, None) is not None:
+                yield char
+
+class GlyphPolicyTableTest(unittest.TestCase):
+    def assertMatchesPolicy(self, policy):
+        table = GlyphPolicyTable(policy)
+        for char in _chars():
+            expected = policy(char)
+            self.assertEqual(table[char], GlyphLayout(expected.should_rotate, expected.should_transpose, expected.should_realign_to_center, expected.should_flush),
+                             u'%s U+%04X %s' % (policy.__name__, ord(char), unicodedata.name(char)))
+
+    def test_yokogaki(self):
+        self.assertMatchesPolicy(YokogakiGlyphPolicy)
+
+    def test_tategaki(self):
+        self.assertMatchesPolicy(TategakiGlyphPolicy)
+
+    def test_memoized(self):
+        table = GlyphPolicyTable(TategakiGlyphPolicy)
+        self.assertTrue(table[u'あ'] is table[u'あ'])
+
+    def test_tategaki_transpose(self):
+        # Upright characters used to call the should_flush property and raise TypeError.
+        self.assertFalse(TategakiGlyphPolicy(u'強').should_transpose)
+        self.assertFalse(TategakiGlyphPolicy(u'あ').should_transpose)
+        self.assertTrue(TategakiGlyphPolicy(u'ぁ').should_transpose)
+        self.assertTrue(TategakiGlyphPolicy(u'。').should_transpose)
+        self.assertTrue(TategakiGlyphPolicy(u'A').should_transpose)
+        table = GlyphPolicyTable(TategakiGlyphPolicy)
+        self.assertEqual(table[u'強'], GlyphLayout(False, False, False, False))
+        self.assertEqual(table[u'ー'], GlyphLayout(True, True, True, False))
+
+if __name__ == '__main__':
+    unittest.main()
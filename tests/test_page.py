@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import unittest
+import Image
+
+from belle import engine
+from belle.page import FlattenedLayerCache, Page, flattened
+
+class Block(object):
+    def __init__(self, box, color, static=True, opaque=True):
+        self.box = box
+        self.color = color
+        self.static = static
+        self.opaque = opaque
+
+    def render(self):
+        self.renders = getattr(self, 'renders', 0) + 1
+        left, top, right, bottom = self.box
+        return Image.new('RGBA', (right - left, bottom - top), self.color), (left, top)
+
+    def signature(self):
+        return (self.__class__.__name__, self.box, self.color, self.static, self.opaque)
+
+    def opaque_box(self):
+        return self.box if self.opaque else None
+
+    def bbox(self):
+        return self.box
+
+class FlattenTest(unittest.TestCase):
+    RED = (255, 0, 0, 255)
+    BLUE = (0, 0, 255, 255)
+
+    def setUp(self):
+        flattened.clear()
+        self.engine = engine.current
+        engine.current = engine.PILEngine()
+
+    def tearDown(self):
+        engine.current = self.engine
+        flattened.clear()
+
+    def test_render(self):
+        page = Page(200, 200, [[Block((60, 60, 140, 140), self.RED)], [Block((0, 0, 20, 20), self.BLUE, static=False)]])
+        im = page.render()
+        self.assertEqual(im.getpixel((100, 100)), self.RED)
+        self.assertEqual(im.getpixel((10, 10)), self.BLUE)
+        self.assertEqual(im.getpixel((150, 150)), Page.BACKGROUND)
+
+    def test_cover_does_not_leak_into_cached_base(self):
+        covered = Page(200, 200, [[Block((60, 60, 140, 140), self.RED)], [Block((0, 0, 200, 200), self.BLUE, static=False)]])
+        self.assertEqual(covered.render().getpixel((100, 100)), self.BLUE)
+
+        uncovered = Page(200, 200, [[Block((60, 60, 140, 140), self.RED)], [Block((0, 0, 20, 20), self.BLUE, static=False)]])
+        self.assertEqual(uncovered.render().getpixel((100, 100)), self.RED)
+        self.assertEqual(uncovered.render(workers=2).getpixel((100, 100)), self.RED)
+
+    def test_uncached_base(self):
+        layers = lambda: [[Block((60, 60, 140, 140), self.RED)], [Block((0, 0, 20, 20), self.BLUE, static=False)]]
+        expected = Page(200, 200, layers()).render().tostring()
+        flattened.clear()
+        flattened.resize(0)
+        try:
+            self.assertEqual(Page(200, 200, layers()).render().tostring(), expected)
+            self.assertEqual(len(flattened), 0)
+        finally:
+            flattened.resize(FlattenedLayerCache.LIMIT)
+
+    def test_static_cover_is_culled(self):
+        page = Page(200, 200, [[Block((60, 60, 140, 140), self.RED), Block((0, 0, 200, 200), self.BLUE)]])
+        self.assertEqual(page.render().getpixel((100, 100)), self.BLUE)
+        self.assertEqual(len(page.plan()), 1)
+
+class StripTest(unittest.TestCase):
+    def setUp(self):
+        flattened.clear()
+        self.engine = engine.current
+        engine.current = engine.PILEngine()
+
+    def tearDown(self):
+        engine.current = self.engine
+
+    def page(self):
+        blocks = [Block((10 * i, 37 * i, 10 * i + 120, 37 * i + 90), (i * 20, 255 - i * 20, 128, 255 if i % 2 else 128), static=False, opaque=bool(i % 2)) for i in xrange(12)]
+        return Page(240, 500, [blocks])
+
+    def test_parallel_strips_match(self):
+        expected = [(top, strip.tostring()) for top, strip in self.page().strips(64)]
+        self.assertEqual([(top, strip.tostring()) for top, strip in self.page().strips(64, workers=3)], expected)
+        self.assertEqual(self.page().render(workers=3).tostring(), self.page().render().tostring())
+
+    def test_parallel_strips_render_lazily(self):
+        page = self.page()
+        strips = page.strips(64, workers=2)
+        strips.next()
+        rendered = [block for block in page.layers[0] if getattr(block, 'renders', 0)]
+        self.assertTrue(all(block.box[1] < 128 for block in rendered))
+        self.assertTrue(len(rendered) < len(page.layers[0]))
+        strips.close()
+
+if __name__ == '__main__':
+    unittest.main()